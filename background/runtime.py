@@ -0,0 +1,186 @@
+import asyncio
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+import paho.mqtt.client as paho
+
+from main.common import log, shard_of
+
+
+class AsyncioSocketHelper:
+    """
+    Drives paho client network IO from asyncio event loop instead of paho's own loop thread.
+    paho may call the socket callbacks from any thread, so all of them go through call_soon_threadsafe.
+    """
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self._open, sock)
+
+    def _open(self, sock):
+        self.loop.add_reader(sock, self.client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self._close, sock)
+
+    def _close(self, sock):
+        self.loop.remove_reader(sock)
+        if self.misc:
+            self.misc.cancel()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.add_writer, sock, self.client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_writer, sock)
+
+    async def misc_loop(self):
+        # keepalive pings and retries of QoS>0 messages
+        while self.client.loop_misc() == paho.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+class AsyncIngest:
+    """
+    Ingest lanes on the event loop, a drop-in for IngestPool of MessageHandler.
+    Every device is pinned to a lane by hash of its uid, lanes run processing in the executor one message
+    at a time, so messages of a device are processed in order.
+    """
+
+    def __init__(self, process, executor, lanes=4, capacity=10000):
+        self.process = process
+        self.executor = executor
+        self.queues = [asyncio.Queue(maxsize=capacity) for _ in range(max(lanes, 1))]
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        pass
+
+    def submit(self, uid: str, *args):
+        """Called on the event loop by paho's on_message. Returns False if the message was dropped."""
+        try:
+            self.queues[shard_of(uid, len(self.queues))].put_nowait((monotonic(), args))
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+    async def lane(self, queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            enqueued, args = await queue.get()
+            try:
+                await loop.run_in_executor(self.executor, self.process, *args)
+            except Exception as e:
+                self.failed += 1
+                log(f'Unable to process message {args}: {e}', log_type='error')
+            latency = monotonic() - enqueued
+            self.processed += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def stats(self):
+        return {
+            'depth': [queue.qsize() for queue in self.queues],
+            'dropped': self.dropped,
+            'processed': self.processed,
+            'failed': self.failed,
+            'latency_avg': self.latency_total / self.processed if self.processed else 0.0,
+            'latency_max': self.latency_max
+        }
+
+
+class AsyncRuntime:
+    """
+    Background daemon on a single asyncio event loop.
+    MQTT network IO runs on the loop, message processing goes through ingest lanes,
+    startup and periodic jobs (automation handlers, task queue, schedules) are structured tasks.
+    Blocking ORM work runs in a bounded thread pool executor.
+    SIGINT/SIGTERM cancel all the tasks and shut the daemon down cleanly.
+    """
+
+    def __init__(self, mqtt, startup=(), periodic=(), executor_workers=4, ingest_lanes=4, reconnect_delay=5):
+        self.mqtt = mqtt
+        self.startup = startup
+        self.periodic = periodic
+        self.executor_workers = executor_workers
+        self.ingest_lanes = ingest_lanes
+        self.reconnect_delay = reconnect_delay
+        self.executor = None
+        self.stopping = None
+
+    def run(self):
+        asyncio.run(self.main())
+
+    def stop(self):
+        if self.stopping:
+            self.stopping.set()
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=self.executor_workers, thread_name_prefix='orm')
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # not the main thread, stop() is still available
+                pass
+
+        handler = self.mqtt.external_handler
+        ingest = AsyncIngest(handler.process, self.executor, lanes=self.ingest_lanes)
+        handler.pool = ingest
+        AsyncioSocketHelper(loop, self.mqtt.raw_client)
+
+        tasks = [loop.create_task(self.keep_connected(), name='mqtt')]
+        tasks += [loop.create_task(ingest.lane(queue), name=f'ingest-{num}') for num, queue in enumerate(ingest.queues)]
+        try:
+            await self.call(self.mqtt.connect)
+            for job in self.startup:
+                log(f'Running {job.__name__}...')
+                await self.call(job)
+            tasks += [
+                loop.create_task(self.every(job, interval), name=job.__name__) for job, interval in self.periodic]
+            log(f'Async runtime started: {len(tasks)} tasks, {self.executor_workers} executor workers')
+            await self.stopping.wait()
+        finally:
+            log('Shutting down async runtime...')
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.mqtt.disconnect()
+            self.executor.shutdown(wait=True)
+            log('Async runtime stopped')
+
+    async def call(self, job, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, job, *args)
+
+    async def every(self, job, interval):
+        while True:
+            started = monotonic()
+            try:
+                await self.call(job)
+            except Exception as e:
+                log(f'{job.__name__} failed: {e}', log_type='error')
+            await asyncio.sleep(max(interval - (monotonic() - started), 0))
+
+    async def keep_connected(self):
+        while True:
+            await asyncio.sleep(self.reconnect_delay)
+            if not self.mqtt.connected:
+                log('Listener is disconnected, reconnecting...', log_type='warning')
+                await self.call(self.mqtt.connect)
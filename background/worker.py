@@ -5,10 +5,16 @@ import abc
 
 from django.utils import timezone
 
-from main.common import log
-from main.models import Scenario, Behavior, Regulator, VirtualDevice, Switch, Sensor, Button
+from main.automation import AutomationEngine, engage_rules, rule_jobs
+from main.common import config, log
+from main.evaluation import EvaluationContext
+from main.executor import TickExecutor
+from main.models import Scenario, Behavior, Regulator, VirtualDevice, Switch, Sensor, Button, StatedModel
+from main.signals import change_listener, subscribe_changes
+from main.state_store import state_store
 from tasks.models import Task
 from main.ops import mqtt_listener as mqtt
+from .runtime import AsyncRuntime
 
 
 class Handler:
@@ -23,18 +29,60 @@ class Handler:
 
 
 class RegularHandler(Handler):
+    """
+    Keeps automation instances of the klass. Refresh is incremental: only new and changed rows are loaded,
+    deleted ones are dropped, unchanged instances are kept with their caches.
+    Rows are changed if updated_at has moved or a change notification has come
+    (updated_at of stated models moves with every state write, so only notifications count for them).
+    """
 
     def __init__(self, klass):
         self.klass = klass
-        self.instances = []
+        self.items = {}
+        self.stamps = {}
+        self.changed = set()
+        self.track_updates = not issubclass(klass, StatedModel)
 
-    def refresh(self):
-        self.instances = list(self.klass.objects.all())
+    @property
+    def instances(self):
+        return list(self.items.values())
 
-    def check(self):
+    def on_change(self, label, pk, action):
+        if label == self.klass._meta.label_lower:
+            self.changed.add(pk)
+
+    def refresh(self):
+        stamps = dict(self.klass.objects.values_list('pk', 'updated_at'))
+        changed, self.changed = self.changed, set()
+        for pk in self.items.keys() - stamps.keys():
+            del self.items[pk]
+        stale = [
+            pk for pk, stamp in stamps.items()
+            if pk not in self.items or pk in changed or self.track_updates and stamp != self.stamps.get(pk)
+        ]
+        self.stamps = stamps
+        if not stale:
+            return
+        for item in self.klass.objects.filter(pk__in=stale):
+            self.items[item.pk] = item
+            if isinstance(item, StatedModel):
+                state_store.seed(item.store_key, item.state)
+        log(f'{self}: {len(stale)} instance(s) loaded', log_type='debug')
+
+    def check(self, context=None):
+        if issubclass(self.klass, (Behavior, Regulator)):
+            engage_rules(self.instances, context or EvaluationContext())
+            return
         for item in self.instances:
             item.engage()
 
+    def jobs(self, context):
+        """Jobs of the tick for TickExecutor."""
+        if issubclass(self.klass, (Behavior, Regulator)):
+            return rule_jobs(self.instances, context)
+        label = self.klass._meta.label_lower
+        return [(f'{label}:{item.pk}', (), item.engage) for item in self.instances]
+
     def __str__(self):
         return f'handler of {self.klass.__name__}'
 
@@ -56,58 +104,99 @@ class TaskHandler(Handler):
 
 
 handler_classes = (Behavior, Regulator, VirtualDevice)  # Behavior
-handlers = [RegularHandler(klass) for klass in handler_classes]
+automation_config = config.get('automation', {})
+# automation.workers > 0 runs automation on a TickExecutor
+executor = TickExecutor(
+    workers=automation_config['workers'],
+    deadline=automation_config.get('deadline', 1.0)
+) if automation_config.get('workers') else None
+if automation_config.get('mode', 'reactive') == 'reactive':
+    engine = AutomationEngine(sweep=automation_config.get('sweep', 60), executor=executor)
+    handlers = []
+else:
+    engine = None
+    handlers = [RegularHandler(klass) for klass in handler_classes]
+    for handler in handlers:
+        subscribe_changes(handler.on_change)
 
 
-def handlers_loop():
-    # Init handlers
+def init_handlers():
+    if engine:
+        engine.start()
+        # rules are updated on change notifications, notifications missed while reconnecting need a rebuild
+        change_listener.on_resync.append(engine.refresh)
     for handler in handlers:
         log(f'Initialize {handler}...')
         handler.refresh()
         if handler.instances:
             log(f'Handle instances: {", ".join([str(i) for i in handler.instances])}')
 
-    while 1:
-        # Process automation handlers
-        for handler in handlers:
-            handler.check()
 
+def check_handlers():
+    # Process automation handlers, conditions shared by the rules are checked once per tick
+    context = EvaluationContext()
+    if executor:
+        executor.run([job for handler in handlers for job in handler.jobs(context)])
+        return
+    for handler in handlers:
+        handler.check(context)
+
+
+def expand_schedules():
+    now = timezone.now()
+    for scenario in Scenario.objects.filter(active=True):
+        for schedule in scenario.schedules.all():
+            next_fire = schedule.next_fire
+            if next_fire and (now + timedelta(hours=6) >= next_fire > now):
+                task = schedule.scenario.schedule_task(next_fire)  # Do we need the task object?!
+
+
+def process_tasks_queue():
+    log(f'Message handler stats: {mqtt.external_handler.stats()}', log_type='debug')
+    # Check for new automation instances in DB
+    # TODO remove somewhere from here
+    if engine:
+        log(f'Automation engine stats: {engine.stats()}', log_type='debug')
+    elif executor:
+        log(f'Automation executor stats: {executor.stats()}', log_type='debug')
+    for handler in handlers:
+        handler.refresh()
+
+    for task in Task.objects.filter(done=False):
+        if task.time_for():
+            task.do()
+
+
+def load_resources():
+    mqtt.external_handler.load_resources(
+        [Switch, Sensor, Button]
+    )
+    # resources are connected and disconnected on change notifications instead of polling DB
+    change_listener.on_resync.append(mqtt.external_handler.resync)
+    change_listener.start()
+
+
+def handlers_loop():
+    init_handlers()
+    while handlers:
+        check_handlers()
         sleep(1)
 
 
 def task_add_queue_loop():
     while 1:
-        now = timezone.now()
-        for scenario in Scenario.objects.filter(active=True):
-            for schedule in scenario.schedules.all():
-                next_fire = schedule.next_fire
-                if next_fire and (now + timedelta(hours=6) >= next_fire > now):
-                    task = schedule.scenario.schedule_task(next_fire)  # Do we need the task object?!
-
+        expand_schedules()
         sleep(60)
 
 
 def process_tasks_queue_loop():
     while 1:
-
-        # Check for new resources in DB
-        # TODO remove somewhere from here
-        mqtt.external_handler.update_resources()
-        # Check for new automation instances in DB
-        # TODO remove somewhere from here
-        for handler in handlers:
-            handler.refresh()
-
-        for task in Task.objects.filter(done=False):
-            if task.time_for():
-                task.do()
+        process_tasks_queue()
         sleep(15)
 
 
 def process_messages_loop():
-    mqtt.external_handler.load_resources(
-        [Switch, Sensor, Button]
-    )
+    load_resources()
     while 1:
         mqtt.wait_for_messages()
         # Wait before reconnect
@@ -125,8 +214,18 @@ def maintenance_the_system():
 log('Running background daemon...')
 maintenance_the_system()
 
-for loop in [process_messages_loop, handlers_loop, process_tasks_queue_loop, task_add_queue_loop]:
-    log(f'Starting thread with {loop} loop...')
-    Thread(target=loop).start()
-    # Let's init slowly
-    sleep(1)
+if config.get('background', {}).get('runtime') == 'asyncio':
+    runtime = AsyncRuntime(
+        mqtt,
+        startup=(load_resources, init_handlers),
+        periodic=(((check_handlers, 1), ) if handlers else ()) + ((process_tasks_queue, 15), (expand_schedules, 60)),
+        executor_workers=config.get('background', {}).get('executor_workers', 4),
+        ingest_lanes=config.get('background', {}).get('ingest_lanes', 4)
+    )
+    runtime.run()
+else:
+    for loop in [process_messages_loop, handlers_loop, process_tasks_queue_loop, task_add_queue_loop]:
+        log(f'Starting thread with {loop} loop...')
+        Thread(target=loop).start()
+        # Let's init slowly
+        sleep(1)
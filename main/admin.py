@@ -26,13 +26,11 @@ def workout(modeladmin, request, queryset):
 
 
 def switches_off(modeladmin, request, queryset):
-    for item in queryset:
-        item.switch("off")
+    Switch.switch_many([switch for item in queryset for switch in item.switches], "off")
 
 
 def switches_on(modeladmin, request, queryset):
-    for item in queryset:
-        item.switch("on")
+    Switch.switch_many([switch for item in queryset for switch in item.switches], "on")
 
 
 def check_switches(modeladmin, request, queryset):
@@ -104,6 +102,11 @@ class GroupAdmin(admin.ModelAdmin):
 class ConAdmin(admin.ModelAdmin):
     list_display = ('__str__', 'check_condition', )
 
+    def get_form(self, request, obj=None, **kwargs):
+        if obj and obj.object:
+            obj.set_channel_choices(obj.object.channels)
+        return super().get_form(request, obj, **kwargs)
+
 
 class BehAdmin(admin.ModelAdmin):
     actions = [check_switches]
@@ -113,6 +116,11 @@ class BehAdmin(admin.ModelAdmin):
 class RegAdmin(admin.ModelAdmin):
     list_display = ('__str__', 'signal')
 
+    def get_form(self, request, obj=None, **kwargs):
+        if obj:
+            obj.set_channel_choices(obj.sensor.channels)
+        return super().get_form(request, obj, **kwargs)
+
 
 class ScenForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
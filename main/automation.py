@@ -0,0 +1,201 @@
+"""Reactive automation: rules are evaluated when the state they depend on changes."""
+import heapq
+from functools import partial
+from threading import Condition, Thread
+from time import monotonic
+
+from .common import log
+from .dependencies import dependency_index
+from .evaluation import EvaluationContext, prefetched
+from .models import Behavior, Regulator, VirtualDevice
+from .rate_limit import rate_limiter
+from .signals import subscribe_changes, subscribe_states
+from .state_store import state_store
+
+
+def rule_jobs(rules, context):
+    """
+    Jobs of Behavior and Regulator rules for TickExecutor: one per behavior keyed by the switches it controls
+    and one for all the regulators, so their commands go in one burst.
+    """
+    # state of the prefetched switches unknown to the state store is read with one query for all the rules
+    context.refresh_many([
+        switch for rule in rules if prefetched(rule, 'switches') for switch in rule.switches.all() if switch.controlled
+    ])
+    jobs, regulators, regulated = [], [], []
+    for rule in rules:
+        switches = [switch.uid for switch in context.controlled_switches(rule)]
+        if isinstance(rule, Regulator):
+            regulators.append(rule)
+            regulated += switches
+        else:
+            jobs.append((f'{rule._meta.label_lower}:{rule.pk}', switches, partial(rule.engage, context)))
+    if regulators:
+        jobs.append((Regulator._meta.label_lower, regulated, partial(Regulator.engage_all, regulators, context)))
+    return jobs
+
+
+def engage_rules(rules, context):
+    """Engages the rules one by one in the calling thread, a failing rule doesn't stop the rest."""
+    for name, _, engage in rule_jobs(rules, context):
+        try:
+            engage()
+        except Exception as e:
+            log(f'Failed to engage {name}: {e}', log_type='error')
+
+
+class AutomationEngine:
+    """
+    Evaluates Behavior and Regulator rules on state changes of the devices they depend on
+    (condition objects, regulated sensors and the switches they control) instead of polling all of them.
+    Dependencies are looked up in the dependency index, which is kept up to date by change notifications.
+    State changes of devices handled by other listener shards come as notifications too.
+    VirtualDevice plugins run on their own timers (settings['interval'] seconds, 1 by default),
+    state they produce triggers dependent rules the same way.
+    Everything is engaged in the engine thread, so rules never run concurrently,
+    unless a TickExecutor is given: then rules and plugins run in its pool, serialized per switch.
+    A slow sweep engages every rule to retry commands held back by the rate limiter (if automation is limited)
+    and to catch up with changes made outside of this process.
+    """
+
+    EVALUATED = (Behavior._meta.label_lower, Regulator._meta.label_lower)
+    VIRTUAL_DEVICE = VirtualDevice._meta.label_lower
+
+    def __init__(self, sweep=60, index=dependency_index, executor=None):
+        self.sweep = sweep
+        self.index = index
+        self.executor = executor
+        self.devices = {}
+        self.timers = []
+        self.dirty = set()
+        self.running = False
+        self.evaluations = 0
+        self.triggers = 0
+        self._cond = Condition()
+        self._thread = None
+
+    @property
+    def rules(self):
+        return [key for key in list(self.index.rules) if key[0] in self.EVALUATED]
+
+    def refresh(self):
+        """Rebuilds the dependency index and reloads virtual devices."""
+        self.index.build()
+        devices = {device.pk: device for device in VirtualDevice.objects.all()}
+        for device in devices.values():
+            state_store.seed(device.store_key, device.state)
+        with self._cond:
+            for pk in devices.keys() - self.devices.keys():
+                heapq.heappush(self.timers, (monotonic(), pk))
+            self.devices = devices
+            self._cond.notify()
+
+    def mark(self, rules):
+        rules = [key for key in rules if key[0] in self.EVALUATED]
+        if rules:
+            with self._cond:
+                self.dirty.update(rules)
+                self._cond.notify()
+
+    def on_state(self, key, channels, version=None):
+        """State store and remote state subscriber: marks the rules depending on the changed channels for evaluation."""
+        rules = self.index.rules_for(key, channels)
+        if rules:
+            self.triggers += 1
+            self.mark(rules)
+
+    def on_change(self, label, pk, action):
+        """Change notification: updates the index and re-evaluates the rules affected."""
+        if label == self.VIRTUAL_DEVICE:
+            device = VirtualDevice.objects.filter(pk=pk).first() if action != 'delete' else None
+            with self._cond:
+                if device is None:
+                    self.devices.pop(pk, None)
+                    return
+                if pk not in self.devices:
+                    heapq.heappush(self.timers, (monotonic(), pk))
+                self.devices[pk] = device
+                self._cond.notify()
+            state_store.seed(device.store_key, device.state)
+            return
+        self.mark(self.index.apply(label, pk, action))
+
+    def start(self):
+        if self.running:
+            return
+        self.refresh()
+        self.running = True
+        state_store.subscribe(self.on_state)
+        subscribe_changes(self.on_change)
+        subscribe_states(self.on_state)
+        self.mark(self.rules)
+        self._thread = Thread(target=self._run, name='automation', daemon=True)
+        self._thread.start()
+        log(f'Automation engine started with {len(self.rules)} rules and {len(self.devices)} virtual devices')
+
+    def stop(self):
+        self.running = False
+        state_store.unsubscribe(self.on_state)
+        with self._cond:
+            self._cond.notify()
+
+    def _run(self):
+        next_sweep = monotonic() + self.sweep
+        while self.running:
+            with self._cond:
+                while self.running and not self.dirty:
+                    deadline = min(next_sweep, self.timers[0][0]) if self.timers else next_sweep
+                    if deadline <= monotonic():
+                        break
+                    self._cond.wait(deadline - monotonic())
+                dirty, self.dirty = self.dirty, set()
+                due = []
+                while self.timers and self.timers[0][0] <= monotonic():
+                    due.append(heapq.heappop(self.timers)[1])
+            if monotonic() >= next_sweep:
+                next_sweep = monotonic() + self.sweep
+                dirty = set(self.rules)
+            if self.executor:
+                self.executor.run(self._jobs(due, dirty))
+                continue
+            for pk in due:
+                self._tick(pk)
+            self._evaluate(dirty)
+
+    def _rules(self, keys):
+        rules = [self.index.rules[key] for key in keys if key in self.index.rules]
+        self.evaluations += len(rules)
+        return rules
+
+    def _jobs(self, due, keys):
+        """Jobs of the tick for TickExecutor."""
+        context = EvaluationContext()
+        jobs = [(f'{self.VIRTUAL_DEVICE}:{pk}', (), partial(self._tick, pk)) for pk in due]
+        return jobs + rule_jobs(self._rules(keys), context)
+
+    def _tick(self, pk):
+        device = self.devices.get(pk)
+        if device is None:
+            return
+        try:
+            device.engage()
+        except Exception as e:
+            log(f'Failed to engage {device}: {e}', log_type='error')
+        interval = device.settings.get('interval', 1) if isinstance(device.settings, dict) else 1
+        with self._cond:
+            heapq.heappush(self.timers, (monotonic() + interval, pk))
+
+    def _evaluate(self, keys):
+        engage_rules(self._rules(keys), EvaluationContext())
+
+    def stats(self):
+        return {
+            'rules': len(self.rules),
+            'index': self.index.stats(),
+            'virtual_devices': len(self.devices),
+            'triggers': self.triggers,
+            'evaluations': self.evaluations,
+            'pending': len(self.dirty),
+            'rate_limit': rate_limiter.stats(),
+            'executor': self.executor.stats() if self.executor else None
+        }
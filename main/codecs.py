@@ -0,0 +1,137 @@
+"""Payload codecs of incoming MQTT messages."""
+import json
+import struct
+
+from .common import config, log
+from .routing import TopicRouter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class TextCodec:
+    """UTF-8 text, the payload as it always was."""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def __call__(self, payload):
+        if isinstance(payload, str):
+            return payload
+        return str(payload, 'utf-8')
+
+
+class JsonCodec:
+    """JSON document, decoded with orjson if it is installed (it reads memoryview without copying)."""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def __call__(self, payload):
+        if orjson:
+            return orjson.loads(payload)
+        if isinstance(payload, memoryview):
+            payload = payload.tobytes()
+        return json.loads(payload)
+
+
+class RawCodec:
+    """
+    Raw binary numbers packed with struct format (little-endian float by default).
+    With channels setting values are returned as a dict of channels, a single value otherwise.
+    """
+
+    def __init__(self, format='<f', channels=None, **kwargs):
+        self.struct = struct.Struct(format)
+        self.channels = channels
+
+    def __call__(self, payload):
+        if isinstance(payload, str):
+            return float(payload)
+        values = self.struct.unpack_from(payload)
+        if self.channels:
+            return dict(zip(self.channels, values))
+        return values[0] if len(values) == 1 else list(values)
+
+
+class MsgpackCodec:
+
+    def __init__(self, **kwargs):
+        if msgpack is None:
+            raise ImportError('msgpack is not installed')
+
+    def __call__(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+class CborCodec:
+
+    def __init__(self, **kwargs):
+        if cbor2 is None:
+            raise ImportError('cbor2 is not installed')
+
+    def __call__(self, payload):
+        if isinstance(payload, memoryview):
+            payload = payload.tobytes()
+        return cbor2.loads(payload)
+
+
+CODECS = {
+    'text': TextCodec,
+    'json': JsonCodec,
+    'raw': RawCodec,
+    'msgpack': MsgpackCodec,
+    'cbor': CborCodec
+}
+
+
+def make_codec(settings):
+    """Codec from a name or a dict with name and options, text codec if it is unknown or unavailable."""
+    if isinstance(settings, str):
+        settings = {'name': settings}
+    settings = dict(settings or {})
+    name = settings.pop('name', 'text')
+    try:
+        return CODECS[name](**settings)
+    except (KeyError, ImportError, TypeError, struct.error) as e:
+        log(f'Unable to use codec {name}: {e}, falling back to text', log_type='error')
+        return TextCodec()
+
+
+class CodecSelector:
+    """
+    Selects payload codec of a message: codec in the device settings goes first,
+    then codec of topic filter from 'codecs' section of config, then text.
+    """
+
+    def __init__(self, topic_codecs=None):
+        self.default = TextCodec()
+        self.by_topic = TopicRouter()
+        self._by_device = {}
+        for topic, settings in (topic_codecs or {}).items():
+            self.by_topic.register(topic, make_codec(settings))
+
+    def forget(self, uid):
+        self._by_device.pop(uid, None)
+
+    def select(self, resource, topic):
+        uid = resource.uid
+        if uid not in self._by_device:
+            settings = getattr(resource, 'settings', None) or {}
+            self._by_device[uid] = make_codec(settings['codec']) if 'codec' in settings else None
+        return self._by_device[uid] or self.by_topic.resolve(topic)[0] or self.default
+
+
+codec_selector = CodecSelector(config.get('codecs'))
@@ -1,23 +1,133 @@
+import atexit
 import json
-from datetime import datetime
 import logging
+import sys
+from copy import copy
+from logging.handlers import QueueHandler, QueueListener
 from os import path
+from queue import Full, Queue
+from zlib import crc32
 
 """Common functions to be used in modules and classes of Syrabond."""
 
 
-def log(line, log_type='info'):
-    """Wrapper for logging. Writes line to log adding datetime."""
-    time_string = datetime.now().strftime("%d.%m.%Y %H:%M:%S")
-    print(time_string, line)
-    if log_type == 'info':
-        logging.info(' {} {}'.format(time_string, line))
-    elif log_type == 'error':
-        logging.error(' {} {}'.format(time_string, line))
-    elif log_type == 'debug':
-        logging.debug(' {} {}'.format(time_string, line))
-    elif log_type == 'warning':
-        logging.warning(' {} {}'.format(time_string, line))
+LOG_TYPES = {
+    'info': logging.INFO,
+    'error': logging.ERROR,
+    'debug': logging.DEBUG,
+    'warning': logging.WARNING
+}
+
+logger = logging.getLogger('syrabond')
+
+
+def log(line, *args, log_type='info', **fields):
+    """
+    Wrapper for logging. Nothing is formatted unless the level is enabled:
+    pass values for %-placeholders of line as args instead of formatting them in place.
+    Keyword fields are written as key=value pairs after the line.
+    Records are formatted and written by the background log writer.
+    """
+    level = LOG_TYPES.get(log_type)
+    if level is None or not logger.isEnabledFor(level):
+        return
+    logger.log(level, line, *args, extra={'fields': fields})
+
+
+def shard_of(key: str, shards: int) -> int:
+    """Stable shard of the key (uid, topic) out of the shards: a key lands on the same one in every process."""
+    return crc32(key.encode()) % shards
+
+
+def format_fields(fields):
+    return ' '.join(f'{key}={value}' for key, value in fields.items())
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Adds fields of the record as key=value pairs."""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + format_fields(fields)
+        return line
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Puts records to the queue, formatting of the line is left to the writer thread. Never blocks.
+    The message is merged with its args and fields are turned to strings in the calling thread though:
+    they may be model instances which change later or query DB in __str__, that must not happen on the writer thread.
+    """
+
+    dropped = 0
+
+    def prepare(self, record):
+        record = copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if getattr(record, 'fields', None):
+            record.fields = {key: str(value) for key, value in record.fields.items()}
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class LogWriter(QueueListener):
+    """
+    Background thread writing log records.
+    Passes at most burst identical lines (message with its fields) per interval,
+    then writes how many of them were suppressed.
+    """
+
+    def __init__(self, queue, *handlers, burst=5, interval=60):
+        super().__init__(queue, *handlers, respect_handler_level=True)
+        self.burst = burst
+        self.interval = interval
+        self.seen = {}
+
+    def handle(self, record):
+        line = record.getMessage()
+        fields = getattr(record, 'fields', None)
+        key = f'{line} {format_fields(fields)}' if fields else line
+        window = self.seen.get(key)
+        if window is None or record.created - window[0] >= self.interval:
+            if window and window[1] > self.burst:
+                record.msg, record.args = f'{line} (repeated {window[1] - self.burst} more times)', None
+            self.seen[key] = [record.created, 1]
+            if len(self.seen) > 10000:
+                self.seen = {
+                    key: value for key, value in self.seen.items() if record.created - value[0] < self.interval}
+        else:
+            window[1] += 1
+            if window[1] > self.burst:
+                return
+        super().handle(record)
+
+
+def start_log_writer(file_name, level, queue_size=100000, burst=5, interval=60):
+    formatter = KeyValueFormatter('%(levelname)s %(asctime)s %(message)s', datefmt='%d.%m.%Y %H:%M:%S')
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if file_name:
+        handlers.append(logging.FileHandler(file_name))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue = Queue(maxsize=queue_size)
+    root = logging.getLogger()
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+    writer = LogWriter(log_queue, *handlers, burst=burst, interval=interval)
+    writer.start()
+    atexit.register(writer.stop)
+    return writer
 
 
 def extract_config(file_path: str) -> dict:
@@ -31,7 +141,7 @@ def extract_config(file_path: str) -> dict:
         with open(file_path, 'r') as f:
             items = json.loads(f.read())
     except Exception as e:
-        log(f'Unable to open config file {file_path}: {e}', 'error')
+        log(f'Unable to open config file {file_path}: {e}', log_type='error')
         return {}
     return items
 
@@ -59,6 +169,8 @@ dir = path.split(path.dirname(path.abspath(__file__)))[0]
 
 config = extract_config(path.join(dir, 'conf.json'))
 log_file = path.join(dir, config.get('logging', {}).get('file', 'log.log'))
-log_level = logging_levels.get(config.get('logging', {}).get('level', 'INFO'))
-if log_file:
-    logging.basicConfig(filename=log_file, level=log_level)
\ No newline at end of file
+log_level_name = str(config.get('logging', {}).get('level', 'INFO')).upper()
+log_level = logging_levels.get(log_level_name, logging.INFO)
+log_writer = start_log_writer(log_file, log_level, **config.get('logging', {}).get('writer', {}))
+if log_level_name not in logging_levels:
+    log(f'Unknown logging level {log_level_name}, INFO is used', log_type='warning')
\ No newline at end of file
@@ -0,0 +1,194 @@
+"""Reverse index from device state to the rules which depend on it."""
+from threading import RLock
+
+from django.db.models import Prefetch
+
+from .evaluation import CONDITION_TARGETS
+from .models import Behavior, Condition, Regulator, Scenario, Sensor, Switch
+
+
+class DependencyIndex:
+    """
+    In-memory index answering "which rules care about device X, channel Y".
+    Device state is addressed by (store key, channel), rules by (model label, pk).
+    (store key, channel) -> conditions -> behaviors and scenarios using them,
+    sensor channel -> regulators, switch state -> behaviors and regulators controlling the switch.
+    The index is built once and then updated incrementally with apply() on change notifications.
+    """
+
+    RULES = {
+        Behavior._meta.label_lower: Behavior,
+        Regulator._meta.label_lower: Regulator,
+        Scenario._meta.label_lower: Scenario
+    }
+    CONDITION = Condition._meta.label_lower
+    SWITCH = Switch._meta.label_lower
+
+    def __init__(self):
+        self._lock = RLock()
+        self.clear()
+
+    def clear(self):
+        self.rules = {}
+        self.dependencies = {}
+        self.dependents = {}
+        self.conditions = {}
+        self.condition_rules = {}
+        self.rule_conditions = {}
+
+    @staticmethod
+    def _queryset(model):
+        # switches come with facilities, their topics are needed to send commands
+        switches = Prefetch('switches', queryset=Switch.objects.select_related('facility'))
+        conditions = Condition.objects.select_related(*CONDITION_TARGETS)
+        if model is Behavior:
+            return Behavior.objects.prefetch_related(
+                switches, Prefetch('conditions_on', queryset=conditions), Prefetch('conditions_off', queryset=conditions))
+        if model is Regulator:
+            return Regulator.objects.select_related('sensor').prefetch_related(switches)
+        return Scenario.objects.prefetch_related(Prefetch('conditions', queryset=conditions))
+
+    @staticmethod
+    def _channel(channel):
+        return channel or 'state'
+
+    def _rule_conditions(self, rule):
+        if isinstance(rule, Behavior):
+            return (*rule.conditions_on.all(), *rule.conditions_off.all())
+        if isinstance(rule, Scenario):
+            return tuple(rule.conditions.all())
+        return ()
+
+    def _rule_dependencies(self, rule, conditions):
+        dependencies = {(condition.object_key, self._channel(condition.channel)) for condition in conditions}
+        if isinstance(rule, Regulator):
+            dependencies.add((Sensor.make_store_key(rule.sensor_id), self._channel(rule.channel)))
+        if not isinstance(rule, Scenario):
+            dependencies.update((Switch.make_store_key(switch.pk), 'state') for switch in rule.switches.all())
+        return {dependency for dependency in dependencies if dependency[0] is not None}
+
+    def _add(self, rule):
+        key = rule._meta.label_lower, rule.pk
+        conditions = self._rule_conditions(rule)
+        dependencies = self._rule_dependencies(rule, conditions)
+        self.rules[key] = rule
+        self.dependencies[key] = dependencies
+        for dependency in dependencies:
+            self.dependents.setdefault(dependency, set()).add(key)
+        self.rule_conditions[key] = {}
+        for condition in conditions:
+            dependency = condition.object_key, self._channel(condition.channel)
+            self.rule_conditions[key][condition.pk] = dependency
+            self.conditions.setdefault(dependency, set()).add(condition.pk)
+            self.condition_rules.setdefault(condition.pk, set()).add(key)
+
+    def _remove(self, key):
+        self.rules.pop(key, None)
+        for dependency in self.dependencies.pop(key, ()):
+            rules = self.dependents.get(dependency)
+            if rules is not None:
+                rules.discard(key)
+                if not rules:
+                    del self.dependents[dependency]
+        for pk, dependency in self.rule_conditions.pop(key, {}).items():
+            rules = self.condition_rules.get(pk, set())
+            rules.discard(key)
+            if rules:
+                continue
+            self.condition_rules.pop(pk, None)
+            conditions = self.conditions.get(dependency, set())
+            conditions.discard(pk)
+            if not conditions:
+                self.conditions.pop(dependency, None)
+
+    def build(self):
+        """(Re)builds the whole index from DB."""
+        with self._lock:
+            self.clear()
+            for model in self.RULES.values():
+                for rule in self._queryset(model):
+                    self._add(rule)
+
+    def reload(self, keys):
+        """Re-reads the rules from DB, the ones which do not exist any more are dropped."""
+        by_model = {}
+        for label, pk in keys:
+            by_model.setdefault(label, set()).add(pk)
+        fresh = []
+        for label, pks in by_model.items():
+            fresh += self._queryset(self.RULES[label]).filter(pk__in=pks)
+        with self._lock:
+            # everything is removed first, so no stale entries of conditions shared by the rules are left
+            for key in keys:
+                self._remove(key)
+            for rule in fresh:
+                self._add(rule)
+
+    def apply(self, label, pk, action):
+        """Updates the index on change of a model instance. Returns keys of the rules affected."""
+        with self._lock:
+            if label in self.RULES:
+                affected = {(label, pk)}
+            elif label == self.CONDITION:
+                affected = set(self.condition_rules.get(pk, ()))
+                if action != 'delete':
+                    condition = Condition.objects.filter(pk=pk).prefetch_related(
+                        'behaviors_on', 'behaviors_off', 'scenarios').first()
+                    if condition:
+                        for rule in (*condition.behaviors_on.all(), *condition.behaviors_off.all(),
+                                     *condition.scenarios.all()):
+                            affected.add((rule._meta.label_lower, rule.pk))
+            elif label == self.SWITCH:
+                affected = {rule for rule in self.dependents.get((Switch.make_store_key(pk), 'state'), ())
+                            if rule[0] != Scenario._meta.label_lower}
+                if action != 'delete':
+                    switch = Switch.objects.filter(pk=pk).values('behavior_id', 'regulator_id').first()
+                    if switch and switch['behavior_id']:
+                        affected.add((Behavior._meta.label_lower, switch['behavior_id']))
+                    if switch and switch['regulator_id']:
+                        affected.add((Regulator._meta.label_lower, switch['regulator_id']))
+            else:
+                return set()
+            self.reload(affected)
+            return affected
+
+    def rules_for(self, key, channels=None):
+        """Keys of the rules depending on the channels of the device (on any of its channels if None)."""
+        if channels is None:
+            return {rule for (dep_key, _), rules in list(self.dependents.items()) if dep_key == key for rule in rules}
+        found = set()
+        for channel in channels:
+            found.update(self.dependents.get((key, channel), ()))
+        return found
+
+    def conditions_for(self, key, channel=None):
+        """pks of the conditions checking the channel of the device (any channel if None)."""
+        if channel is not None:
+            return set(self.conditions.get((key, channel), ()))
+        return {pk for (dep_key, _), pks in list(self.conditions.items()) if dep_key == key for pk in pks}
+
+    def dependencies_of(self, label, pk):
+        """(store key, channel) pairs the rule depends on."""
+        return set(self.dependencies.get((label, pk), ()))
+
+    def watched_channels(self, key):
+        """Channels of the device any rule depends on."""
+        return {channel for dep_key, channel in list(self.dependents) if dep_key == key}
+
+    def describe(self, key):
+        """Human readable map of channel -> rules depending on the device."""
+        described = {}
+        for (dep_key, channel), rules in list(self.dependents.items()):
+            if dep_key == key:
+                described[channel] = sorted(str(self.rules[rule]) for rule in rules if rule in self.rules)
+        return described
+
+    def stats(self):
+        return {
+            'rules': len(self.rules),
+            'dependencies': len(self.dependents),
+            'conditions': len(self.condition_rules)
+        }
+
+
+dependency_index = DependencyIndex()
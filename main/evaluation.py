@@ -0,0 +1,99 @@
+"""Per tick evaluation context shared by automation rules."""
+from threading import RLock
+
+from .state_store import state_store
+
+CONDITION_TARGETS = ('sensor', 'switch', 'virtual_device')
+
+
+def prefetched(obj, relation):
+    return relation in getattr(obj, '_prefetched_objects_cache', {})
+
+
+class EvaluationContext:
+    """
+    Caches of one evaluation tick: conditions of rules with their target devices are fetched once,
+    every condition is checked once however many rules share it,
+    devices not tracked by the state store are read from DB once, so rules kept between ticks see their fresh state.
+    Create a new context for every tick, results are not invalidated.
+    Jobs of a tick run in parallel by TickExecutor share the context, so access to the caches is locked.
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.related = {}
+        self.states = {}
+        self.checks = 0
+        self.hits = 0
+        self._lock = RLock()
+
+    def conditions(self, rule, relation):
+        """Conditions of the rule relation (conditions_on, conditions...), prefetched ones are used as is."""
+        manager = getattr(rule, relation)
+        if prefetched(rule, relation):
+            return list(manager.all())
+        key = rule._meta.label_lower, rule.pk, relation
+        with self._lock:
+            if key not in self.related:
+                self.related[key] = list(manager.select_related(*CONDITION_TARGETS))
+            return self.related[key]
+
+    def controlled_switches(self, rule):
+        """Controlled switches of the rule, state of the ones unknown to the state store is read for the tick."""
+        with self._lock:
+            if prefetched(rule, 'switches'):
+                switches = [switch for switch in rule.switches.all() if switch.controlled]
+            else:
+                key = rule._meta.label_lower, rule.pk, 'switches'
+                if key not in self.related:
+                    self.related[key] = list(rule.switches.filter(controlled=True).select_related('facility'))
+                    self.seed(self.related[key])
+                switches = self.related[key]
+            self.refresh_many(switches)
+            return switches
+
+    def check(self, condition):
+        """Result of the condition, memoized for the tick."""
+        with self._lock:
+            self.checks += 1
+            if condition.pk in self.results:
+                self.hits += 1
+                return self.results[condition.pk]
+            result = condition.check_condition(context=self)
+            if condition.pk is not None:
+                self.results[condition.pk] = result
+            return result
+
+    def refresh(self, obj):
+        """Refreshes state of the device from DB once per tick."""
+        key = obj.store_key
+        with self._lock:
+            if key in self.states:
+                obj.state = self.states[key]
+            else:
+                obj.refresh_from_db(fields=['state'])
+                self.states[key] = obj.state
+
+    def seed(self, objs):
+        """Takes state of the devices just loaded from DB as fresh for the tick."""
+        with self._lock:
+            for obj in objs:
+                self.states.setdefault(obj.store_key, obj.state)
+
+    def refresh_many(self, objs):
+        """
+        Refreshes state of the devices of one model which are not tracked by the state store
+        (e.g. handled by another listener shard) with one query per tick.
+        """
+        with self._lock:
+            stale = [obj for obj in objs if obj.store_key not in state_store and obj.store_key not in self.states]
+            if stale:
+                states = dict(type(stale[0]).objects.filter(pk__in=[obj.pk for obj in stale]).values_list('pk', 'state'))
+                for obj in stale:
+                    self.states[obj.store_key] = states.get(obj.pk, obj.state)
+            for obj in objs:
+                if obj.store_key not in state_store:
+                    obj.state = self.states[obj.store_key]
+
+    def stats(self):
+        return {'checks': self.checks, 'hits': self.hits, 'conditions': len(self.results)}
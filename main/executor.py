@@ -0,0 +1,123 @@
+"""Parallel execution of automation work with per-device ordering."""
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from threading import Lock
+from time import monotonic
+
+from .common import log
+
+
+class TickExecutor:
+    """
+    Runs the jobs of an automation tick on a thread pool.
+    A job is (name, keys, func): jobs sharing a key (uid of a switch they command) never run at the same time,
+    so commands to one device stay serialized; jobs without common keys run in parallel,
+    a slow one (e.g. a plugin doing HTTP) holds back nothing but itself.
+    A job is handed to the pool only when all its keys are free, waiting jobs never occupy workers;
+    jobs waiting for a key are started in the order they came.
+    Every worker thread keeps its own DB connection for the life of the pool.
+    run() waits for the tick until the deadline, jobs still running after it are reported as an overrun.
+    A job submitted again while it is still running is not queued twice: only its latest version
+    is run once the running one finishes.
+    """
+
+    def __init__(self, workers=4, deadline=1.0):
+        self.workers = workers
+        self.deadline = deadline
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='automation')
+        self.busy = set()
+        self.pending = []
+        self.running = set()
+        self.reruns = {}
+        self.ticks = 0
+        self.jobs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.failed = 0
+        self.tick_max = 0.0
+        self._lock = Lock()
+
+    def _ready(self):
+        """Takes the pending jobs whose keys are free, called under the lock."""
+        ready, pending, blocked = [], [], set()
+        for job in self.pending:
+            keys = job[1]
+            if keys & self.busy or keys & blocked:
+                # later jobs with any of these keys wait behind this one
+                blocked |= keys
+                pending.append(job)
+            else:
+                self.busy |= keys
+                ready.append(job)
+        self.pending = pending
+        return ready
+
+    def _submit(self, jobs):
+        for job in jobs:
+            self.pool.submit(self._call, *job)
+
+    def _call(self, name, keys, func, future):
+        try:
+            func()
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            log(f'Automation job {name} failed: {e}', log_type='error')
+        finally:
+            with self._lock:
+                self.busy -= keys
+                rerun = self.reruns.pop(name, None)
+                if rerun is None:
+                    self.running.discard(name)
+                else:
+                    self.pending.append((name, *rerun))
+                ready = self._ready()
+            future.set_result(None)
+            self._submit(ready)
+
+    def run(self, jobs):
+        """Runs the jobs and waits for them until the deadline. Returns True if the tick finished in time."""
+        started = monotonic()
+        futures = []
+        with self._lock:
+            for name, keys, func in jobs:
+                future = Future()
+                futures.append(future)
+                if name in self.running:
+                    replaced = self.reruns.get(name)
+                    if replaced:
+                        replaced[2].set_result(None)
+                    self.reruns[name] = set(keys), func, future
+                    self.skipped += 1
+                    continue
+                self.running.add(name)
+                self.jobs += 1
+                self.pending.append((name, set(keys), func, future))
+            ready = self._ready()
+        self._submit(ready)
+        _, late = wait(futures, timeout=self.deadline)
+        elapsed = monotonic() - started
+        with self._lock:
+            self.ticks += 1
+            self.tick_max = max(self.tick_max, elapsed)
+            if late:
+                self.overruns += 1
+            running = sorted(self.running)
+        if late:
+            log(f'Automation tick overrun: {len(late)} of {len(futures)} jobs still running after {self.deadline}s: '
+                f'{", ".join(running)}', log_type='warning')
+        return not late
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'ticks': self.ticks,
+            'jobs': self.jobs,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'tick_max': self.tick_max,
+            'pending': len(self.pending)
+        }
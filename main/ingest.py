@@ -0,0 +1,87 @@
+from threading import Lock, Thread
+from time import monotonic
+
+from .common import log, shard_of
+from .mqttsender import Queue
+
+
+class IngestPool:
+    """
+    Pool of workers which takes processing of incoming messages off the paho network thread.
+    The network callback only enqueues, workers drain their queues and do database work.
+    Every device is pinned to one worker by hash of its uid, so its messages are processed in order.
+    """
+
+    def __init__(self, process, workers=4, capacity=10000, overflow=Queue.DROP_OLDEST, block_timeout=1.0):
+        self.process = process
+        # submit() runs on the paho network thread, blocking it for long stops keepalives
+        self.block_timeout = block_timeout
+        self.queues = [Queue(capacity=capacity, overflow=overflow) for _ in range(max(workers, 1))]
+        self.threads = []
+        self.running = False
+        self.processed = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self._lock = Lock()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        for num, queue in enumerate(self.queues):
+            thread = Thread(target=self._work, args=(queue, ), name=f'ingest-{num}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        log(f'Ingest pool started with {len(self.queues)} worker(s)')
+
+    def stop(self, timeout=5):
+        self.running = False
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def submit(self, uid: str, *args):
+        """Enqueues args of process() to the worker owning the uid. Returns False if the message was dropped."""
+        queue = self.queues[shard_of(uid, len(self.queues))]
+        if queue.enqueue((monotonic(), args), timeout=self.block_timeout):
+            return True
+        # the same line (no uid field) for every drop, so the log writer folds repeats
+        log('Ingest queue is full, message dropped', log_type='warning')
+        return False
+
+    def _work(self, queue):
+        while self.running:
+            item = queue.dequeue(block=True, timeout=1)
+            if item is None:
+                continue
+            enqueued, args = item
+            failed = False
+            try:
+                self.process(*args)
+            except Exception as e:
+                failed = True
+                log(f'Unable to process message {args}: {e}', log_type='error')
+            latency = monotonic() - enqueued
+            with self._lock:
+                self.processed += 1
+                self.failed += failed
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+
+    def stats(self):
+        with self._lock:
+            processed, latency_total = self.processed, self.latency_total
+            latency_max, failed = self.latency_max, self.failed
+        return {
+            'depth': [len(queue) for queue in self.queues],
+            'high_water': [queue.high_water for queue in self.queues],
+            'dropped': sum(queue.dropped for queue in self.queues),
+            'processed': processed,
+            'failed': failed,
+            'latency_avg': latency_total / processed if processed else 0.0,
+            'latency_max': latency_max
+        }
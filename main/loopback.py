@@ -0,0 +1,275 @@
+"""
+In-process MQTT broker stand-in.
+LoopbackClient implements the part of paho Client API used by Mqtt and Publisher on top of LoopbackBroker,
+so the listener/sender path can be load tested and benchmarked with no external broker.
+Supports connect, subscribe with '+'/'#' wildcards, retained messages, QoS 0/1 and persistent sessions
+(QoS 1 messages are kept for disconnected clients with clean_session=False).
+Network loop of a client is a thread draining its inbox, as paho's loop_start/loop_forever do.
+"""
+from collections import deque
+from itertools import count
+from threading import Condition, Lock, Thread, current_thread
+from time import time
+
+import paho.mqtt.client as mqtt
+
+
+class LoopbackMessage:
+
+    def __init__(self, topic, payload, qos=0, retain=False, mid=0):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = mid
+        self.timestamp = time()
+
+
+class LoopbackMessageInfo:
+    """Counterpart of paho MQTTMessageInfo: the broker acknowledges synchronously."""
+
+    def __init__(self, mid, rc=mqtt.MQTT_ERR_SUCCESS):
+        self.mid = mid
+        self.rc = rc
+
+    def wait_for_publish(self, timeout=None):
+        if self.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise RuntimeError(f'Message publish failed: {mqtt.error_string(self.rc)}')
+
+    def is_published(self):
+        return self.rc == mqtt.MQTT_ERR_SUCCESS
+
+
+class _Session:
+
+    def __init__(self):
+        self.subscriptions = {}
+        self.pending = deque()
+        self.client = None
+
+
+class LoopbackBroker:
+
+    def __init__(self):
+        self.sessions = {}
+        self.retained = {}
+        self.published = 0
+        self.delivered = 0
+        self._lock = Lock()
+
+    def connect(self, client):
+        with self._lock:
+            session = self.sessions.get(client.client_id)
+            if session is None or client.clean_session:
+                session = self.sessions[client.client_id] = _Session()
+            session.client = client
+            pending, session.pending = session.pending, deque()
+        for message in pending:
+            client.deliver(message)
+
+    def disconnect(self, client):
+        with self._lock:
+            session = self.sessions.get(client.client_id)
+            if session and session.client is client:
+                session.client = None
+                if client.clean_session:
+                    del self.sessions[client.client_id]
+
+    def subscribe(self, client, topics):
+        with self._lock:
+            session = self.sessions[client.client_id]
+            session.subscriptions.update(topics)
+            retained = [
+                LoopbackMessage(topic, payload, min(qos, sub_qos), retain=True)
+                for sub, sub_qos in topics
+                for topic, (payload, qos) in self.retained.items() if mqtt.topic_matches_sub(sub, topic)
+            ]
+        for message in retained:
+            client.deliver(message)
+
+    def unsubscribe(self, client, topics):
+        with self._lock:
+            session = self.sessions[client.client_id]
+            for topic in topics:
+                session.subscriptions.pop(topic, None)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        deliveries = []
+        with self._lock:
+            self.published += 1
+            if retain:
+                if payload:
+                    self.retained[topic] = (payload, qos)
+                else:
+                    self.retained.pop(topic, None)
+            for session in self.sessions.values():
+                granted = [sub_qos for sub, sub_qos in session.subscriptions.items()
+                           if mqtt.topic_matches_sub(sub, topic)]
+                if not granted:
+                    continue
+                message = LoopbackMessage(topic, payload, min(qos, max(granted)))
+                if session.client:
+                    deliveries.append((session.client, message))
+                elif message.qos:
+                    session.pending.append(message)
+        for client, message in deliveries:
+            client.deliver(message)
+            self.delivered += 1
+
+
+broker = LoopbackBroker()
+
+
+class LoopbackClient:
+
+    def __init__(self, client_id='', clean_session=True, userdata=None, broker=broker, **kwargs):
+        self.client_id = client_id
+        self.clean_session = clean_session
+        self.broker = broker
+        self._userdata = userdata
+        self._connected = False
+        self._inbox = deque()
+        self._inbox_ready = Condition()
+        self._thread = None
+        self._looping = False
+        self._connect_on_loop = False
+        self._mids = count(1)
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_socket_open = self.on_socket_close = None
+        self.on_socket_register_write = self.on_socket_unregister_write = None
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+
+    def max_inflight_messages_set(self, inflight):
+        pass
+
+    def user_data_set(self, userdata):
+        self._userdata = userdata
+
+    def is_connected(self):
+        return self._connected
+
+    def connect(self, host='', port=1883, keepalive=60, **kwargs):
+        self.broker.connect(self)
+        self._connected = True
+        self._post_state(self._connected_event)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def connect_async(self, host='', port=1883, keepalive=60, **kwargs):
+        self._connect_on_loop = True
+
+    def reconnect(self):
+        return self.connect()
+
+    def disconnect(self, *args, **kwargs):
+        if self._connected:
+            self._connected = False
+            self.broker.disconnect(self)
+            self._post_state(self._disconnected_event)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        mid = next(self._mids)
+        if not self._connected:
+            return LoopbackMessageInfo(mid, mqtt.MQTT_ERR_NO_CONN)
+        if payload is None:
+            payload = b''
+        elif isinstance(payload, str):
+            payload = payload.encode()
+        elif isinstance(payload, (int, float)):
+            payload = str(payload).encode()
+        self.broker.publish(topic, bytes(payload), qos, retain)
+        return LoopbackMessageInfo(mid)
+
+    def subscribe(self, topic, qos=0, options=None, properties=None):
+        if not self._connected:
+            return mqtt.MQTT_ERR_NO_CONN, None
+        topics = [(topic, qos)] if isinstance(topic, str) else [
+            (item, qos) if isinstance(item, str) else item for item in topic]
+        self.broker.subscribe(self, topics)
+        return mqtt.MQTT_ERR_SUCCESS, next(self._mids)
+
+    def unsubscribe(self, topic, properties=None):
+        if not self._connected:
+            return mqtt.MQTT_ERR_NO_CONN, None
+        self.broker.unsubscribe(self, [topic] if isinstance(topic, str) else topic)
+        return mqtt.MQTT_ERR_SUCCESS, next(self._mids)
+
+    def deliver(self, message):
+        """Called by the broker: puts the message to the inbox drained by the network loop."""
+        self._post(lambda: self.on_message and self.on_message(self, self._userdata, message))
+
+    def _post(self, event):
+        with self._inbox_ready:
+            self._inbox.append(event)
+            self._inbox_ready.notify()
+
+    def _post_state(self, event):
+        """
+        Connection events go through the inbox when the network loop runs, otherwise they are run in place:
+        a client without a loop (e.g. the sender) would never drain them.
+        """
+        if self._looping:
+            self._post(event)
+        else:
+            event()
+
+    def _connected_event(self):
+        if self.on_connect:
+            self.on_connect(self, self._userdata, {'session present': 0}, mqtt.MQTT_ERR_SUCCESS)
+
+    def _disconnected_event(self):
+        if self.on_disconnect:
+            self.on_disconnect(self, self._userdata, mqtt.MQTT_ERR_SUCCESS)
+
+    def loop(self, timeout=1.0, max_packets=1):
+        with self._inbox_ready:
+            if not self._inbox:
+                self._inbox_ready.wait(timeout)
+            events, self._inbox = self._inbox, deque()
+        for event in events:
+            event()
+        return mqtt.MQTT_ERR_SUCCESS if self._connected else mqtt.MQTT_ERR_NO_CONN
+
+    def loop_forever(self, timeout=1.0, max_packets=1, retry_first_connection=False):
+        self._looping = True
+        if self._connect_on_loop or retry_first_connection and not self._connected:
+            self._connect_on_loop = False
+            self.connect()
+        while self._looping and (self._connected or self._inbox):
+            self.loop(timeout)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_start(self):
+        if self._thread is not None:
+            return mqtt.MQTT_ERR_INVAL
+        self._looping = True
+        self._thread = Thread(target=self.loop_forever, name=f'loopback-{self.client_id}', daemon=True)
+        self._thread.start()
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_stop(self, force=False):
+        if self._thread is None:
+            return mqtt.MQTT_ERR_INVAL
+        self._looping = False
+        with self._inbox_ready:
+            self._inbox_ready.notify()
+        if current_thread() != self._thread:
+            self._thread.join()
+        self._thread = None
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_read(self, max_packets=1):
+        return self.loop(0)
+
+    def loop_write(self, max_packets=1):
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_misc(self):
+        return mqtt.MQTT_ERR_SUCCESS if self._connected else mqtt.MQTT_ERR_NO_CONN
@@ -0,0 +1,54 @@
+from random import Random
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+
+from main.models import Condition, Sensor
+from main.state_store import state_store
+
+
+def legacy_check(condition):
+    """Condition.check_condition as it was before compiled predicates: eval of string comparison."""
+    channel = condition.channel if condition.channel else 'state'
+    state = str(state_store.get(condition.object_key, channel)).lower()
+    return eval(f'"{state}" {condition.comparison} "{condition.state.lower()}"')
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares Condition.check_condition with compiled predicates against the legacy eval path '
+        'on synthetic conditions of sensors in the state store (no DB needed)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--conditions', type=int, default=1000)
+        parser.add_argument('--checks', type=int, default=200000)
+
+    def handle(self, *args, **options):
+        rnd = Random(0)
+        conditions = []
+        for num in range(options['conditions']):
+            uid = f'bench_sensor{num}'
+            state_store.seed(Sensor.make_store_key(uid), {'temp': rnd.uniform(0, 40), 'state': rnd.choice(('on', 'off'))})
+            if num % 4:
+                condition = Condition(sensor_id=uid, channel='temp', comparison=rnd.choice('<>'), state=str(rnd.randint(0, 40)))
+            else:
+                condition = Condition(sensor_id=uid, channel='state', comparison=rnd.choice(('==', '!=')), state='on')
+            conditions.append(condition)
+        checks = [rnd.choice(conditions) for _ in range(options['checks'])]
+
+        mismatched = sum(1 for condition in conditions if legacy_check(condition) != condition.check_condition())
+        self.stdout.write(
+            f'{mismatched} of {len(conditions)} conditions evaluate differently '
+            f'(numeric thresholds compared as strings by eval)')
+
+        for title, check in (('legacy eval', legacy_check), ('compiled predicate', Condition.check_condition)):
+            started = perf_counter()
+            for condition in checks:
+                check(condition)
+            elapsed = perf_counter() - started
+            self.stdout.write(
+                f'{title}: {len(checks)} checks in {elapsed:.3f}s, '
+                f'{len(checks) / elapsed:.0f} predicates/s, {elapsed / len(checks) * 1e6:.2f} us/check')
+        for condition in conditions:
+            state_store.forget(condition.object_key)
@@ -0,0 +1,61 @@
+import logging
+import os
+from contextlib import redirect_stdout
+from datetime import datetime
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+
+from main.common import log, logger
+
+legacy_logger = logging.getLogger('syrabond.bench.legacy')
+
+
+def legacy_log(line, log_type='info'):
+    """common.log as it was before the log writer: formats and writes in the caller's thread."""
+    time_string = datetime.now().strftime("%d.%m.%Y %H:%M:%S")
+    print(time_string, line)
+    if log_type == 'info':
+        legacy_logger.info(' {} {}'.format(time_string, line))
+    elif log_type == 'debug':
+        legacy_logger.debug(' {} {}'.format(time_string, line))
+
+
+class Command(BaseCommand):
+    help = 'Measures per-message overhead of common.log against the legacy synchronous implementation'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=100000)
+
+    def handle(self, *args, **options):
+        count = options['count']
+        payload, topic = b'{"temp": 21.5, "hum": 40}', 'home/sensor/bench/state'
+        legacy_logger.propagate = False
+        legacy_logger.setLevel(logger.getEffectiveLevel())
+        devnull = open(os.devnull, 'w')
+        legacy_logger.addHandler(logging.StreamHandler(devnull))
+        cases = (
+            ('legacy, debug line (level disabled)',
+             lambda: legacy_log(f' Got {payload} in {topic}', log_type='debug')),
+            ('log, debug line (level disabled)',
+             lambda: log('Got message', log_type='debug', topic=topic, payload=payload)),
+            ('legacy, info line',
+             lambda: legacy_log(f'Sending {payload} to {topic}...')),
+            ('log, info line',
+             lambda: log('Sending', topic=topic, msg=payload)),
+        )
+        try:
+            with redirect_stdout(devnull):
+                results = [(title, self.measure(call, count)) for title, call in cases]
+        finally:
+            legacy_logger.handlers.clear()
+            devnull.close()
+        for title, elapsed in results:
+            self.stdout.write(f'{title}: {elapsed / count * 1e6:.2f} us/message')
+
+    @staticmethod
+    def measure(call, count):
+        started = perf_counter()
+        for _ in range(count):
+            call()
+        return perf_counter() - started
@@ -0,0 +1,58 @@
+from threading import Event, Thread
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+
+from main.common import config
+from main.mqttsender import Mqtt, Publisher
+
+
+class CountingHandler:
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.received = 0
+        self.done = Event()
+
+    def handle(self, topic=None, payload=None):
+        self.received += 1
+        if self.received >= self.expected:
+            self.done.set()
+
+
+class Command(BaseCommand):
+    help = 'Measures throughput of sender -> broker -> listener path on the in-process loopback broker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=20000)
+        parser.add_argument('--devices', type=int, default=500)
+        parser.add_argument('--batch', type=int, default=100, help='items per publish_many call')
+        parser.add_argument('--qos', type=int, default=1)
+
+    def handle(self, *args, **options):
+        mqtt_config = {
+            'object_name': 'bench', 'server': 'loopback', 'ping_topic': 'bench/ping', 'user': '', 'password': '',
+            **config.get('mqtt', {}), 'transport': 'loopback'}
+        bench_config = {**config, 'mqtt': mqtt_config}
+        count, batch = options['count'], options['batch']
+
+        handler = CountingHandler(count)
+        listener = Mqtt('bench_listener', config=bench_config, handler=handler)
+        listener.subscribe_many([f'bench/sensor/dev{num}/#' for num in range(options['devices'])])
+        Thread(target=listener.wait_for_messages, daemon=True).start()
+        publisher = Publisher('bench_publisher', config=bench_config, qos=options['qos'])
+
+        items = [
+            (f'bench/sensor/dev{num % options["devices"]}/temp', str(num), False) for num in range(count)]
+        started = perf_counter()
+        for pos in range(0, count, batch):
+            publisher.publish_many(items[pos:pos + batch])
+        published = perf_counter() - started
+        handler.done.wait(60)
+        received = perf_counter() - started
+        publisher.stop()
+        listener.disconnect()
+
+        self.stdout.write(f'published {count} messages in {published:.3f}s, {count / published:.0f} msg/s')
+        self.stdout.write(
+            f'received {handler.received} messages in {received:.3f}s, {handler.received / received:.0f} msg/s')
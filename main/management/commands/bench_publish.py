@@ -0,0 +1,49 @@
+from time import perf_counter
+from uuid import uuid4 as uuid
+
+from django.core.management.base import BaseCommand
+
+from main.common import config
+from main.mqttsender import Mqtt, Publisher
+
+
+class Command(BaseCommand):
+    help = 'Compares commands per second of per-command connections (Mqtt.mqttsend) and of the persistent Publisher'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=200, help='commands to send with each sender')
+        parser.add_argument('--connections', type=int, default=1, help='connections of the persistent publisher')
+        parser.add_argument('--qos', type=int, default=1, help='QoS of the persistent publisher')
+        parser.add_argument('--topic', default=None, help='topic prefix, <object_name>/bench by default')
+
+    def handle(self, *args, **options):
+        count = options['count']
+        prefix = options['topic'] or f"{config['mqtt']['object_name']}/bench"
+        topics = [f'{prefix}/{num % 50}' for num in range(count)]
+
+        sender = Mqtt('syrabond_bench_' + str(uuid()), clean_session=True)
+        self.report('mqttsend (connect per command)', count, self.run(sender.mqttsend, topics))
+
+        publisher = Publisher(
+            'syrabond_bench_' + str(uuid()), connections=options['connections'], qos=options['qos'])
+        publisher.start()
+        try:
+            self.report(
+                f"Publisher.mqttsend ({options['connections']} conn, qos {options['qos']})",
+                count, self.run(publisher.mqttsend, topics))
+        finally:
+            publisher.stop()
+
+    @staticmethod
+    def run(send, topics):
+        failed = 0
+        started = perf_counter()
+        for topic in topics:
+            if not send(topic, 'bench'):
+                failed += 1
+        return perf_counter() - started, failed
+
+    def report(self, title, count, result):
+        elapsed, failed = result
+        self.stdout.write(
+            f'{title}: {count} commands in {elapsed:.3f}s, {count / elapsed:.1f} cmd/s, {failed} failed')
@@ -0,0 +1,58 @@
+from random import Random
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from main.models import ConnectedResource, Facility, Regulator, Sensor, Switch
+from main.mqttsender import Dumb
+
+from .replay_traffic import QueryCounter
+
+
+def legacy_engage(regulator):
+    """Regulator.engage as it was before batching: signal and switch state read for every switch."""
+    for switch in regulator.switches.filter(controlled=True):
+        if regulator.signal() is True and switch.switched_off:
+            switch.on()
+        if regulator.signal() is False and switch.switched_on:
+            switch.off()
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares DB queries and time of engaging regulators one by one (legacy) and with Regulator.engage_all. '
+        'Synthetic regulators are created in a transaction which is rolled back, commands are not published.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--regulators', type=int, default=200)
+        parser.add_argument('--switches', type=int, default=2, help='controlled switches per regulator')
+
+    def handle(self, *args, **options):
+        ConnectedResource.sender = Dumb()
+        with transaction.atomic():
+            self.populate(options['regulators'], options['switches'])
+            for title, engage in (
+                    ('legacy', lambda: [legacy_engage(regulator) for regulator in Regulator.objects.all()]),
+                    ('engage_all', Regulator.engage_all)):
+                counter = QueryCounter()
+                started = perf_counter()
+                with connection.execute_wrapper(counter):
+                    engage()
+                elapsed = perf_counter() - started
+                self.stdout.write(
+                    f'{title}: {options["regulators"]} regulators in {elapsed:.3f}s, {counter.count} queries')
+            transaction.set_rollback(True)
+
+    def populate(self, regulators, switches):
+        rnd = Random(0)
+        facility = Facility.objects.create(title='bench', key='bench')
+        for num in range(regulators):
+            sensor = Sensor.objects.create(
+                uid=f'bench_sensor{num}', title='bench', facility=facility, state={'temp': rnd.uniform(10, 30)})
+            regulator = Regulator.objects.create(sensor=sensor, channel='temp', lower_bond=18, upper_bond=22)
+            for pos in range(switches):
+                Switch.objects.create(
+                    uid=f'bench_switch{num}_{pos}', title='bench', facility=facility, controlled=True,
+                    regulator=regulator, state={'state': rnd.choice(('on', 'off'))})
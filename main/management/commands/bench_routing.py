@@ -0,0 +1,61 @@
+from random import Random
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+
+from main.routing import TopicRouter
+
+
+def legacy_resolve(resources, topic):
+    """Routing as MessageHandler.handle did it before TopicRouter: first level matching any uid."""
+    topic_items = topic.split('/')
+    for pos, item in enumerate(topic_items):
+        if item in resources:
+            channel = '.'.join(topic_items[pos + 1:]) or None
+            return resources[item], channel
+    return None, None
+
+
+class Command(BaseCommand):
+    help = 'Compares topic routing of TopicRouter with the legacy uid scan on synthetic devices'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=10000)
+        parser.add_argument('--messages', type=int, default=200000)
+        parser.add_argument('--facilities', type=int, default=10)
+
+    def handle(self, *args, **options):
+        rnd = Random(0)
+        devices, topics = {}, []
+        for num in range(options['devices']):
+            facility = f'fac{num % options["facilities"]}'
+            uid = f'dev{num}'
+            if num % 3:
+                topic = f'{facility}/sensor/{uid}/#'
+                sample = f'{facility}/sensor/{uid}/{rnd.choice(("temp", "hum", "pressure"))}'
+            elif num % 7:
+                topic = f'{facility}/switch/{uid}'
+                sample = topic
+            else:
+                topic = f'{facility}/custom/+/{uid}'
+                sample = f'{facility}/custom/zone{num % 5}/{uid}/state'
+            devices[uid] = topic
+            topics.append(sample)
+        messages = [rnd.choice(topics) for _ in range(options['messages'])]
+
+        started = perf_counter()
+        router = TopicRouter()
+        for uid, topic in devices.items():
+            router.register(topic, uid)
+        self.stdout.write(f'TopicRouter: {len(router)} topics registered in {perf_counter() - started:.3f}s')
+
+        for title, resolve in (
+                ('legacy scan', lambda topic: legacy_resolve(devices, topic)),
+                ('TopicRouter', router.resolve)):
+            started = perf_counter()
+            for topic in messages:
+                resolve(topic)
+            elapsed = perf_counter() - started
+            self.stdout.write(
+                f'{title}: {len(messages)} topics in {elapsed:.3f}s, '
+                f'{len(messages) / elapsed:.0f} topics/s, {elapsed / len(messages) * 1e6:.2f} us/topic')
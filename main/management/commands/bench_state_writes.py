@@ -0,0 +1,62 @@
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from main.models import Facility, Sensor
+from main.write_buffer import JSONBPatch
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares full-row save() with jsonb patch updates of a sensor state: time and WAL volume. '
+        'A synthetic sensor is written in a transaction which is rolled back, '
+        'so no change notifications are sent and real devices are not touched.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = options['count']
+        with transaction.atomic():
+            facility = Facility.objects.create(title='bench', key='bench')
+            sensor = Sensor.objects.create(
+                uid='bench_sensor', title='bench', facility=facility, state={'temp': 21.5, 'hum': 40})
+            self.compare(sensor, count)
+            transaction.set_rollback(True)
+
+    def compare(self, sensor, count):
+        def full_save(num):
+            sensor.state.update({'bench': num})
+            sensor.save()
+
+        def patch(num):
+            sensor.state.update({'bench': num})
+            Sensor.objects.filter(pk=sensor.pk).update(
+                state=JSONBPatch('state', {'bench': num}), updated_at=timezone.now())
+
+        for title, write in (('save()', full_save), ('jsonb patch', patch)):
+            wal_start = self.wal_lsn()
+            started = perf_counter()
+            for num in range(count):
+                write(num)
+            elapsed = perf_counter() - started
+            wal = self.wal_diff(wal_start)
+            self.stdout.write(
+                f'{title}: {count} writes in {elapsed:.3f}s, {count / elapsed:.0f} writes/s, '
+                f'WAL {wal} bytes ({wal / count:.0f} bytes/write)')
+
+    # insert position: WAL of the open transaction is not flushed yet
+    @staticmethod
+    def wal_lsn():
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_current_wal_insert_lsn()')
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def wal_diff(start):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_wal_lsn_diff(pg_current_wal_insert_lsn(), %s)', [start])
+            return int(cursor.fetchone()[0])
@@ -0,0 +1,77 @@
+from time import perf_counter, sleep
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from main.models import ConnectedResource, Switch, Sensor, Button
+from main.mqttsender import Dumb
+from main.ops import MessageHandler
+from main.traffic import read_traffic
+
+
+class QueryCounter:
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = (
+        'Replays traffic recorded by the listener (mqtt.record) through MessageHandler.handle without a broker '
+        'and reports throughput, latency percentiles and DB queries per message. '
+        'It writes device state to the configured database, use a copy of it.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='file recorded by the listener')
+        parser.add_argument('--speed', type=float, default=0, help='1 is real time, N is N times faster, 0 is max')
+        parser.add_argument('--limit', type=int, default=0, help='replay only the first messages')
+        parser.add_argument('--publish', action='store_true', help='let automation send commands to the broker')
+
+    def handle(self, *args, **options):
+        if not options['publish']:
+            ConnectedResource.sender = Dumb()
+        handler = MessageHandler()
+        handler.load_resources([Switch, Sensor, Button], subscribe=False)
+        self.stdout.write(f'{len(handler.resources)} resources loaded')
+
+        latencies = []
+        counter = QueryCounter()
+        speed = options['speed']
+        first = started = None
+        try:
+            with connection.execute_wrapper(counter):
+                for timestamp, topic, payload in read_traffic(options['file']):
+                    if first is None:
+                        first, started = timestamp, perf_counter()
+                    if speed:
+                        delay = (timestamp - first) / speed - (perf_counter() - started)
+                        if delay > 0:
+                            sleep(delay)
+                    handled = perf_counter()
+                    handler.handle(topic=topic, payload=payload)
+                    latencies.append(perf_counter() - handled)
+                    if options['limit'] and len(latencies) >= options['limit']:
+                        break
+        except FileNotFoundError as e:
+            raise CommandError(e)
+        if not latencies:
+            raise CommandError('Nothing to replay')
+        self.report(latencies, perf_counter() - started, counter.count)
+
+    def report(self, latencies, elapsed, queries):
+        count = len(latencies)
+        latencies.sort()
+
+        def percentile(p):
+            return latencies[min(int(count * p / 100), count - 1)] * 1000
+
+        self.stdout.write(f'{count} messages in {elapsed:.3f}s, {count / elapsed:.1f} msg/s')
+        self.stdout.write(
+            f'latency ms: p50 {percentile(50):.3f}, p90 {percentile(90):.3f}, '
+            f'p99 {percentile(99):.3f}, max {latencies[-1] * 1000:.3f}')
+        self.stdout.write(f'{queries} DB queries, {queries / count:.2f} per message')
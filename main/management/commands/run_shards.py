@@ -0,0 +1,62 @@
+import signal
+import subprocess
+import sys
+from time import sleep
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.common import config, log
+from main.models import Switch, Sensor, Button
+from main.ops import mqtt_listener as mqtt
+from main.signals import change_listener
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs MQTT listener shards in separate processes, mqtt.shards in config is the total number of shards. '
+        'Devices are split between shards by hash of uid, so messages of a device are processed by one process in order. '
+        'The background daemon handles shard 1, this command runs the rest of them, '
+        'or only the one given with --shard.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', type=int, help='run only this shard (1-based) in the current process')
+
+    def handle(self, *args, **options):
+        shards = config.get('mqtt', {}).get('shards', 1)
+        if shards <= 1:
+            raise CommandError('Set mqtt.shards in config to more than 1 to run listener shards')
+        if options['shard'] is None:
+            self.spawn(shards)
+        elif 1 <= options['shard'] <= shards:
+            self.listen(options['shard'] - 1, shards)
+        else:
+            raise CommandError(f'Shard must be between 1 and {shards}')
+
+    def spawn(self, shards):
+        processes = [
+            subprocess.Popen([sys.executable, sys.argv[0], 'run_shards', '--shard', str(shard)])
+            for shard in range(2, shards + 1)
+        ]
+        self.stdout.write(f'Started {len(processes)} listener shard(s)')
+
+        def stop(signum, frame):
+            for process in processes:
+                process.terminate()
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        for process in processes:
+            process.wait()
+
+    def listen(self, shard, shards):
+        handler = mqtt.external_handler
+        handler.shard, handler.shards = shard, shards
+        log(f'Running listener shard {shard + 1}/{shards}...')
+        handler.load_resources([Switch, Sensor, Button])
+        change_listener.on_resync.append(handler.resync)
+        change_listener.start()
+        while 1:
+            mqtt.wait_for_messages()
+            # Wait before reconnect
+            sleep(60)
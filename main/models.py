@@ -1,5 +1,6 @@
 import json
 from datetime import datetime, timedelta
+from functools import cached_property
 
 import django.db.models
 from django.utils import timezone
@@ -8,11 +9,16 @@ from django.db.models import JSONField
 from django.core.validators import validate_comma_separated_integer_list
 from typing import List
 
-from main.ops import mqtt_sender, mqtt_listener
+from main.ops import mqtt_sender, mqtt_listener, Comm
 from . import plugins, state_processors
 from .tasks_interface import Taskable
 from main.utils import get_resources, get_classes, instance_klass
 from .common import log
+from .state_store import state_store
+from .evaluation import EvaluationContext, prefetched
+from .predicates import compile_predicate
+from .rate_limit import rate_limiter
+from .write_buffer import state_writer, patch_json
 
 DAYS_OF_WEEK = (
     (0, 'Monday'),
@@ -75,9 +81,23 @@ class StatedModel(models.Model):
         default=dict
     )
 
+    @classmethod
+    def make_store_key(cls, pk):
+        return f'{cls._meta.label_lower}:{pk}'
+
+    @property
+    def store_key(self):
+        return self.make_store_key(self.pk)
+
+    @property
+    def live_state(self):
+        """State from the process-wide state store if the object is tracked there, own state otherwise."""
+        state = state_store.view(self.store_key)
+        return self.state if state is None else state
+
     @property
     def channels(self):
-        return list(self.state.keys())
+        return list(self.live_state.keys())
 
     def get_state(self, channel=None):
         if self.state is None:
@@ -85,10 +105,11 @@ class StatedModel(models.Model):
             self.save()
             return None
         else:
+            state = self.live_state
             if channel:
-                return self.state.get(channel)
+                return state.get(channel)
             else:
-                return self.state.get('state') or self.state.get('data')
+                return state.get('state') or state.get('data')
 
     get_state.short_description = 'Состояние'
 
@@ -97,21 +118,50 @@ class StatedModel(models.Model):
             processor = instance_klass(self.PROCESSORS, self.state_processor, settings=self.settings)
             processed_state = processor(raw_state=state)
             self.state.update(processed_state)
+            return processed_state
         except Exception as e:
             log(f'Unable to process state of {self}: {e}')
-
-    def update_state(self, state, channel=None):
+            return {}
+
+    def state_is_urgent(self, channels):
+        """Whether the update of channels must be written at once instead of being coalesced."""
+        return True
+
+    def update_state(self, state, channel=None) -> list:
+        """
+        Applies the incoming state. Returns the channels which have changed,
+        nothing is written if the state is the same as it was (e.g. retained messages replayed on reconnect).
+        """
+        tracked = self.store_key in state_store
+        previous = None if tracked else dict(self.state or {})
         if self.state_processor:
-            self.process_state(state)
+            patch = self.process_state(state)
         else:
             if isinstance(state, str) and state.isdigit():
                 state = float(state)
-            if channel:
-                self.state.update({channel: state})
+            if isinstance(state, dict):
+                # payload decoded by a structured codec is a dict of channels
+                patch = {f'{channel}.{key}' if channel else key: value for key, value in state.items()}
+                self.state.update(patch)
+            elif channel:
+                patch = {channel: state}
+                self.state.update(patch)
             else:
+                patch = None
                 self.state = {'state': state}
 
-        self.save()
+        if tracked:
+            changed = state_store.put(self.store_key, self.state)
+        else:
+            changed = [channel for channel, value in self.state.items() if previous.get(channel, self) != value]
+            changed += [channel for channel in previous if channel not in self.state]
+        if not changed:
+            state_writer.skip()
+            return changed
+        if patch is not None:
+            patch = {channel: value for channel, value in patch.items() if channel in changed}
+        state_writer.add(self, patch=patch, urgent=self.state_is_urgent(list(patch or self.state)))
+        return changed
 
     class Meta:
         abstract = True
@@ -148,8 +198,7 @@ class SetWithSwitches:
         return get_resources(self, qs='switch_resources')
 
     def switch(self, cmd, **kwargs):
-        for switch in self.switches:
-            switch.switch(cmd, direct=True)
+        Switch.switch_many(self.switches, cmd)
 
 
 class Group(BaseModel, TitledModel, SetWithSwitches):
@@ -253,20 +302,21 @@ class Premise(BaseModel, TitledModel, UsingChannelsModel):
             print(e)
 
     def set_lights(self, settings):
-        lights = self.lights
-        for light in lights:
-            if hasattr(light, settings):
-                getattr(light, settings)()
+        Switch.switch_many(self.lights, settings)
 
     @property
     def temp(self):
-        return self.heating_sensor.state.get(
-            'state', self.heating_sensor.state.get('temp')) if self.heating_sensor else '---'
+        if not self.heating_sensor:
+            return '---'
+        state = self.heating_sensor.live_state
+        return state.get('state', state.get('temp'))
 
     @property
     def hum(self):
-        return self.heating_sensor.state.get(
-            'state', self.heating_sensor.state.get('hum', '---')) if self.heating_sensor else '---'
+        if not self.heating_sensor:
+            return '---'
+        state = self.heating_sensor.live_state
+        return state.get('state', state.get('hum', '---'))
 
     @property
     def switches(self):
@@ -368,6 +418,10 @@ class Resource(BaseModel, TitledModel):
     def __repr__(self):
         return str(self)
 
+    @classmethod
+    def make_store_key(cls, pk):
+        return pk
+
     @property
     def topic(self):
         if self.pk:
@@ -417,10 +471,7 @@ class VirtualDevice(BaseModel, TitledModel, StatedModel):
         data = inst(service=self.service_data)
         if isinstance(data, dict):
             if 'service' in data:
-                self.service_data.update(
-                    data.pop('service')
-                )
-                self.save()
+                patch_json(self, 'service_data', data.pop('service'))
             for channel, state in data.items():
                 self.update_state(state, channel=channel)
         elif data:
@@ -486,6 +537,33 @@ class SwitchApp(ConnectedResource, StatedModel, Taskable):
         if hasattr(self, cmd):
             getattr(self, cmd)(direct=direct)
 
+    @classmethod
+    def switch_many(cls, switches, cmd, direct=True, rules=None):
+        """
+        Sends cmd to all the switches in one burst.
+        Commands other than plain on/off are passed to each switch one by one.
+        Indirect commands skip the switches held back by the rate limiter,
+        rules maps uid of a switch to the automation rule commanding it for its rate limit policy.
+        """
+        switches = list(switches)
+        if cmd not in Comm.command_map:
+            return [switch.switch(cmd, direct=direct) for switch in switches]
+        if not direct:
+            rules = rules or {}
+            allowed = [
+                switch for switch in switches
+                if rate_limiter.allow(switch.uid, rate_limiter.policy(switch, rules.get(switch.uid)))]
+            if len(allowed) < len(switches):
+                log('%s commands %s are rate limited', len(switches) - len(allowed), cmd, log_type='debug')
+            switches = allowed
+        if not switches:
+            return []
+        try:
+            return cls.sender.publish_many([(switch.topic, cmd, True) for switch in switches])
+        except Exception as e:
+            log(f'Error while publishing {cmd} to {len(switches)} switches: {e}', log_type='error')
+            return [False] * len(switches)
+
     def publish_cmd(self, cmd):
         try:
             self.sender.mqttsend(self.topic, cmd, retain=True)
@@ -494,15 +572,14 @@ class SwitchApp(ConnectedResource, StatedModel, Taskable):
             print(f'Error while publishing {self.uid} {cmd}: {e}')
             return False
 
-    def _turn(self, position, direct=False):
+    def _turn(self, position, direct=False, rule=None):
         # Process direct command
         if direct:
             return self.publish_cmd(position)
-        # Process indirect command (automation, etc)
-        if datetime.fromtimestamp(self.extra.get('freeze_until', 0)) <= datetime.now():
-            self.extra.update({'freeze_until': datetime.timestamp(datetime.now() + timedelta(minutes=1))})
-            self.save()
-            self.publish_cmd(position)
+        # Process indirect command (REST, automation rule), debounced in memory without DB writes
+        if rate_limiter.allow(self.uid, rate_limiter.policy(self, rule)):
+            return self.publish_cmd(position)
+        log('Command %s to %s is rate limited', position, self.uid, log_type='debug')
 
     def schedule_task(self, scheduled: datetime, command: str):
         action, _ = Action.objects.get_or_create(
@@ -580,7 +657,7 @@ class Button(ConnectedResource, StatedModel):
 
     def _process_new_state(self, state):
         try:
-            cmd = json.loads(state)
+            cmd = state if isinstance(state, dict) else json.loads(state)
             self.push(cmd.get('action'))
         except Exception as e:
             log(f'Unable to parse data from device {self.uid}: {e}', log_type='error')
@@ -637,8 +714,10 @@ class Switch(SwitchApp):
             self.update_state("off")
 
     def update_state(self, state, channel=None):
-        super().update_state(state, channel=None)
-        self._process_new_state(state)
+        changed = super().update_state(state, channel=None)
+        if changed:
+            self._process_new_state(state)
+        return changed
 
     def _process_new_state(self, state):
         if state == 'on':
@@ -647,8 +726,8 @@ class Switch(SwitchApp):
 
         # HERE you can put some state processing logics
 
-    def on(self, direct=True):
-        self._turn('on', direct)
+    def on(self, direct=True, rule=None):
+        self._turn('on', direct, rule)
 
     def _schedule_auto_off(self):
         scheduled_on = timezone.now() + timedelta(
@@ -657,8 +736,8 @@ class Switch(SwitchApp):
             seconds=self.auto_off_after.second)
         self.schedule_task(scheduled_on, 'off')
 
-    def off(self, direct=True):
-        self._turn('off', direct)
+    def off(self, direct=True, rule=None):
+        self._turn('off', direct, rule)
 
     def toggle(self, direct=True):
         try:
@@ -685,6 +764,16 @@ class Sensor(SensorApp, StatedModel):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+    @cached_property
+    def watched_channels(self):
+        """Channels that conditions and regulators depend on, dropped by MessageHandler when they change."""
+        channels = set(self.conditions.values_list('channel', flat=True))
+        channels.update(self.regulators.values_list('channel', flat=True))
+        return {channel or 'state' for channel in channels}
+
+    def state_is_urgent(self, channels):
+        return any(channel in self.watched_channels for channel in channels)
+
     class Meta:
         verbose_name = 'Датчик',
         verbose_name_plural = 'Датчики'
@@ -742,8 +831,14 @@ class Regulator(BaseModel, UsingChannelsModel):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        if self.pk:
-            self._meta.get_field('channel').choices = [(ch, ch) for ch in self.sensor.channels]
+        # no query for channels of the sensor here, regulators are loaded in batches,
+        # RegAdmin sets choices of sensors unknown to the state store
+        key = Sensor.make_store_key(self.sensor_id)
+        if self.pk and key in state_store:
+            self.set_channel_choices(state_store.channels(key))
+
+    def set_channel_choices(self, channels):
+        self._meta.get_field('channel').choices = [(ch, ch) for ch in channels]
 
     sensor = models.ForeignKey(
         Sensor,
@@ -774,8 +869,13 @@ class Regulator(BaseModel, UsingChannelsModel):
         default=True
     )
 
-    def signal(self):
-        self.sensor.refresh_from_db()
+    def signal(self, fresh=False, context=None):
+        """fresh means the sensor has just been loaded from DB, no need to refresh it."""
+        if not fresh and self.sensor_id not in state_store:
+            if context:
+                context.refresh(self.sensor)
+            else:
+                self.sensor.refresh_from_db()
         metric = self.sensor.get_state(self.channel)
         try:
             metric = float(metric)
@@ -786,12 +886,58 @@ class Regulator(BaseModel, UsingChannelsModel):
         if metric <= self.lower_bond:
             return self.direction
 
-    def engage(self):
-        for switch in self.switches.filter(controlled=True):
-            if self.signal() is True and switch.switched_off:
-                switch.on()
-            if self.signal() is False and switch.switched_on:
-                switch.off()
+    def commands(self, fresh=False, context=None):
+        """Switches to turn on and off by the signal of the regulator, the signal is computed once."""
+        context = context or EvaluationContext()
+        signal = self.signal(fresh=fresh, context=context)
+        if signal is None:
+            return [], []
+        switches = context.controlled_switches(self)
+        if signal:
+            return [switch for switch in switches if switch.switched_off], []
+        return [], [switch for switch in switches if switch.switched_on]
+
+    def engage(self, context=None):
+        to_on, to_off = self.commands(context=context)
+        for switch in to_on:
+            switch.on(direct=False, rule=self)
+        for switch in to_off:
+            switch.off(direct=False, rule=self)
+
+    @classmethod
+    def engage_all(cls, regulators=None, context=None):
+        """
+        Engages many regulators at once: all of them with sensors and controlled switches
+        are loaded in a fixed number of queries (unless given), every signal is computed once
+        and the commands are sent in one burst per command.
+        State of given regulators' sensors and prefetched switches unknown to the state store
+        is read in one query per model.
+        """
+        fresh = regulators is None
+        context = context or EvaluationContext()
+        if fresh:
+            regulators = list(cls.objects.select_related('sensor').prefetch_related(
+                models.Prefetch('switches', queryset=Switch.objects.filter(controlled=True).select_related('facility'))))
+            context.seed([switch for regulator in regulators for switch in regulator.switches.all()])
+        else:
+            regulators = list(regulators)
+            context.refresh_many([regulator.sensor for regulator in regulators])
+            context.refresh_many([
+                switch for regulator in regulators if prefetched(regulator, 'switches')
+                for switch in regulator.switches.all()])
+        to_on, to_off, rules = {}, {}, {}
+        for regulator in regulators:
+            try:
+                on, off = regulator.commands(fresh=fresh, context=context)
+            except Exception as e:
+                log(f'Failed to engage {regulator}: {e}', log_type='error')
+                continue
+            to_on.update((switch.uid, switch) for switch in on)
+            to_off.update((switch.uid, switch) for switch in off)
+            rules.update((switch.uid, regulator) for switch in (*on, *off))
+        Switch.switch_many(to_on.values(), 'on', direct=False, rules=rules)
+        Switch.switch_many(to_off.values(), 'off', direct=False, rules=rules)
+        return len(to_on), len(to_off)
 
     def __str__(self):
         vector = f"{self.upper_bond}->{self.lower_bond}" if self.direction is False else f"{self.lower_bond}->{self.upper_bond}"
@@ -932,8 +1078,13 @@ class Condition(BaseModel, UsingChannelsModel):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        if self.pk:
-            self._meta.get_field('channel').choices = [(ch, ch) for ch in self.object.channels]
+        # no query for channels of the object here, conditions are loaded in batches,
+        # ConAdmin sets choices of objects unknown to the state store
+        if self.pk and self.object_key in state_store:
+            self.set_channel_choices(state_store.channels(self.object_key))
+
+    def set_channel_choices(self, channels):
+        self._meta.get_field('channel').choices = [(ch, ch) for ch in channels]
 
     switch = models.ForeignKey(
         Switch,
@@ -988,10 +1139,35 @@ class Condition(BaseModel, UsingChannelsModel):
     def object(self):
         return self.sensor if self.sensor else self.switch if self.switch else self.virtual_device
 
-    def check_condition(self):
-        state = self.object.state.get(self.channel if self.channel else 'state')
-        state = str(state).lower()
-        return eval(f'"{state}" {self.comparison} "{self.state.lower()}"')
+    @property
+    def object_key(self):
+        """Store key of the object, no need to fetch it."""
+        if self.sensor_id:
+            return Sensor.make_store_key(self.sensor_id)
+        if self.switch_id:
+            return Switch.make_store_key(self.switch_id)
+        if self.virtual_device_id:
+            return VirtualDevice.make_store_key(self.virtual_device_id)
+
+    @cached_property
+    def predicate(self):
+        return compile_predicate(self.comparison, self.state)
+
+    def check_condition(self, context=None):
+        channel = self.channel if self.channel else 'state'
+        if self.object_key in state_store:
+            state = state_store.get(self.object_key, channel)
+        else:
+            obj = self.object
+            if context:
+                context.refresh(obj)
+            state = obj.state.get(channel)
+        return self.predicate(state)
+
+    def save(self, *args, **kwargs):
+        # comparison or state may have changed
+        self.__dict__.pop('predicate', None)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f'{self.object} {(str(self.channel) + " ") if self.channel else ""}{self.comparison} {self.state}'
@@ -1047,9 +1223,40 @@ class Action(BaseModel, Taskable):
     def object(self):
         return self.switch if self.switch else self.group if self.group else self.tag
 
+    @property
+    def switches(self):
+        return [self.switch] if self.switch else self.object.switches if self.object else []
+
     def __str__(self):
         return f'{self.object} = {self.state}'
 
+    @classmethod
+    def do_many(cls, actions):
+        """
+        Performs the actions in their order, plain on/off commands of consecutive actions
+        of the same kind are sent in one burst.
+        """
+        runs = []
+        for action in actions:
+            if action.state not in Comm.command_map:
+                runs.append((None, action))
+                continue
+            log('Performing the action ' + str(action))
+            try:
+                switches = {switch.uid: switch for switch in action.switches}
+            except Exception as e:
+                log(f'Failed to perform {action}: {e}')
+                continue
+            if runs and runs[-1][0] == action.state:
+                runs[-1][1].update(switches)
+            else:
+                runs.append((action.state, switches))
+        for cmd, run in runs:
+            if cmd is None:
+                run.do()
+            else:
+                Switch.switch_many(run.values(), cmd)
+
     def schedule_task(self, scheduled: datetime):
         return self.create_task(action=self, scheduled=scheduled)
 
@@ -1078,10 +1285,12 @@ class ConditionTypedModel(models.Model):
         default='&'
     )
 
-    def target_conditions(self, conditions: django.db.models.QuerySet):
-        if conditions.none():
-            return False
-        all_conditions = (condition.check_condition() for condition in conditions.all())
+    def target_conditions(self, conditions, context=None):
+        """conditions is a queryset or a list of conditions, results are memoized in the context."""
+        context = context or EvaluationContext()
+        if isinstance(conditions, django.db.models.Manager):
+            conditions = conditions.all()
+        all_conditions = (context.check(condition) for condition in conditions)
         if self.conditions_type == '|':
             return any(all_conditions)
         else:
@@ -1108,25 +1317,32 @@ class Behavior(BaseModel, TitledModel, ConditionTypedModel):
 
     @property
     def on(self):
-        return self.target_conditions(self.conditions_on)
+        return self.is_on(EvaluationContext())
 
     @property
     def off(self):
-        if self.conditions_off.exists():
-            return self.target_conditions(self.conditions_off)
-        return not self.on
+        return self.is_off(EvaluationContext())
 
-    def engage(self):
+    def is_on(self, context):
+        return self.target_conditions(context.conditions(self, 'conditions_on'), context)
 
-        if self.off:
-            for switch in self.switches.filter(controlled=True):
+    def is_off(self, context):
+        conditions_off = context.conditions(self, 'conditions_off')
+        if conditions_off:
+            return self.target_conditions(conditions_off, context)
+        return not self.is_on(context)
+
+    def engage(self, context=None):
+        context = context or EvaluationContext()
+        if self.is_off(context):
+            for switch in context.controlled_switches(self):
                 if switch.state_ == 'on':
-                    switch.off()
+                    switch.off(direct=False, rule=self)
                     return
-        if self.on:
-            for switch in self.switches.filter(controlled=True):
+        if self.is_on(context):
+            for switch in context.controlled_switches(self):
                 if switch.state_ == 'off':
-                    switch.on()
+                    switch.on(direct=False, rule=self)
 
     class Meta:
         verbose_name = 'Поведение',
@@ -1157,8 +1373,7 @@ class Scenario(BaseModel, TitledModel, ConditionTypedModel, Taskable):
 
     def work_out(self):
         log('Running the scenario ' + str(self))
-        for action in self.actions.all():
-            action.do()
+        Action.do_many(self.actions.all())
         for button in self.buttons.all():
             button.push()
 
@@ -1176,9 +1391,9 @@ class Scenario(BaseModel, TitledModel, ConditionTypedModel, Taskable):
         for task in tasks:
             task.cancel()
 
-    def engage(self):
+    def engage(self, context=None):
         # We don't check schedule anymore, be AWARE!
-        if self.active and self.target_conditions(conditions=self.conditions):
+        if self.active and self.target_conditions(self.conditions, context):
             self.work_out()
 
     def save(self, *args, **kwargs):
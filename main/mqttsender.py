@@ -1,32 +1,100 @@
 import paho.mqtt.client as mqtt
 import sys
-from time import sleep
-from .common import config, log
+from collections import deque
+from threading import Condition, Event, Lock
+from time import monotonic, sleep
+
+from .common import config, log, shard_of
+from .routing import TopicRouter
 
 
 class Queue:
+    """
+    Bounded FIFO ring buffer.
+    When it is full the overflow policy decides: drop the oldest item, drop the new one or block the producer.
+    Dropped items and the high-water mark are counted.
+    """
 
-    def __init__(self, l=()):
-        self.queue = list(l)
-        self.size = self.queue.__len__()
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    BLOCK = 'block'
+    POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+    def __init__(self, l=(), capacity=10000, overflow=DROP_OLDEST):
+        if overflow not in self.POLICIES:
+            raise ValueError(f'Unknown overflow policy {overflow}, expected one of {self.POLICIES}')
+        self.capacity = capacity
+        self.overflow = overflow
+        self.queue = deque(l, maxlen=capacity)
+        self.dropped = 0
+        self.high_water = len(self.queue)
+        lock = Lock()
+        self._not_full = Condition(lock)
+        self._not_empty = Condition(lock)
 
     def __repr__(self):
-        return f'Queue {self.queue}'
+        return f'Queue {list(self.queue)}'
 
-    def enqueue(self, n):
-        self.queue.insert(0, n)
-        self.size += 1
+    def __len__(self):
+        return len(self.queue)
 
-    def dequeue(self):
-        if self.size > 0:
-            self.size -= 1
-            return self.queue.pop()
-        else:
+    @property
+    def size(self):
+        return len(self.queue)
+
+    def enqueue(self, n, timeout=None):
+        """Puts n to the buffer. Returns False if n was dropped."""
+        with self._not_full:
+            if len(self.queue) >= self.capacity:
+                if self.overflow == self.DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                if self.overflow == self.BLOCK:
+                    if not self._not_full.wait_for(lambda: len(self.queue) < self.capacity, timeout):
+                        self.dropped += 1
+                        return False
+                else:
+                    # deque with maxlen pushes the oldest item out itself
+                    self.dropped += 1
+            self.queue.append(n)
+            if len(self.queue) > self.high_water:
+                self.high_water = len(self.queue)
+            self._not_empty.notify()
+            return True
+
+    def dequeue(self, block=False, timeout=None):
+        """Takes the oldest item. Returns None if the buffer is empty (after timeout if block)."""
+        with self._not_empty:
+            if block and not self._not_empty.wait_for(lambda: self.queue, timeout):
+                return None
+            if self.queue:
+                self._not_full.notify()
+                return self.queue.popleft()
             return None
 
     def clear(self):
-        self.queue.clear()
-        self.size = 0
+        with self._not_full:
+            self.queue.clear()
+            self._not_full.notify_all()
+
+    def stats(self):
+        return {
+            'size': len(self.queue),
+            'capacity': self.capacity,
+            'dropped': self.dropped,
+            'high_water': self.high_water
+        }
+
+
+def make_client(client_id, clean_session, mqtt_config):
+    """paho client, or the in-process LoopbackClient if mqtt.transport is 'loopback'."""
+    if mqtt_config.get('transport') == 'loopback':
+        from .loopback import LoopbackClient
+        client = LoopbackClient(client_id, clean_session=clean_session)
+    else:
+        client = mqtt.Client(client_id, clean_session=clean_session)
+    client.username_pw_set(username=mqtt_config['user'], password=mqtt_config['password'])
+    return client
 
 
 class SingletonDecorator:
@@ -56,13 +124,18 @@ class Mqtt:
         self.root = mqtt_config['object_name']
         self.broker = mqtt_config['server']
         self.ping_topic = mqtt_config['ping_topic']
-        self._client = mqtt.Client(self.name, clean_session=self.clean_session)
-        self._client.username_pw_set(username=mqtt_config['user'], password=mqtt_config['password'])
+        self._client = make_client(self.name, self.clean_session, mqtt_config)
         self._client.on_message = self.process_message
         self._client.on_disconnect = self.on_disconnect
-        self.message_buffer = Queue()
+        buffer_config = mqtt_config.get('buffer', {})
+        self.message_buffer = Queue(
+            capacity=buffer_config.get('capacity', 10000),
+            overflow=buffer_config.get('overflow', Queue.DROP_OLDEST)
+        )
         self.external_handler = handler
-        self.subscriptions = []
+        self.recorder = None
+        self.subscriptions = set()
+        self._wildcards = TopicRouter()
 
     @property
     def client(self):
@@ -71,9 +144,14 @@ class Mqtt:
                 sleep(1)
         return self._client
 
+    @property
+    def raw_client(self):
+        """Underlying paho client, unlike client it does not connect implicitly."""
+        return self._client
+
     def connect(self):
         try:
-            print('Connecting...')
+            log('Connecting to %s...', self.broker, log_type='debug')
             if not self._client.connect(self.broker):
                 self.connected = True
         except Exception as e:
@@ -86,25 +164,41 @@ class Mqtt:
     def mqttsend(self, topic: str, msg: str, retain=False):
         """Sends msg to topic. Logs activity and errors."""
         try:
-            log(f'Sending {msg} to {topic}...')
+            log('Sending', log_type='debug', topic=topic, msg=msg)
             self.client.publish(topic, msg, retain=retain)
         except Exception as e:
-            log('Error while sending: {}.'.format(e), log_type='error')
+            log('Error while sending: %s.', e, log_type='error', topic=topic)
             return False
-        print('Message sent.')
-        log('Message sent.', log_type='debug')
+        log('Message sent.', log_type='debug', topic=topic)
         if self.clean_session:
             self.disconnect()
-            self.connected = False
-            print('Disconnected')
         return True
 
+    def publish_many(self, items):
+        """
+        Sends (topic, msg, retain) items over one connection.
+        Returns list of results in the order of items.
+        """
+        results = []
+        try:
+            log('Sending %s messages...', len(items), log_type='debug')
+            client = self.client
+            for topic, msg, retain in items:
+                results.append(client.publish(topic, msg, retain=retain).rc == mqtt.MQTT_ERR_SUCCESS)
+        except Exception as e:
+            log('Error while sending: {}.'.format(e), log_type='error')
+        results += [False] * (len(items) - len(results))
+        log('%s of %s messages sent.', results.count(True), len(items), log_type='debug')
+        if self.clean_session:
+            self.disconnect()
+        return results
+
     def subscribe(self, topic):
         """Subscribes to the topic specifies. Logs activity and errors."""
         try:
-            if topic not in self.subscriptions:
+            if not self.is_subscribed(topic):
                 self.client.subscribe(topic)
-                self.subscriptions.append(topic)
+                self._add_subscriptions([topic])
                 log('Subscribed: '+topic)
             else:
                 log('Already subscribed on '+topic, log_type='debug')
@@ -113,6 +207,50 @@ class Mqtt:
             log('Could not subscribe: ' + str(e), log_type='error')
             return False
 
+    def is_subscribed(self, topic):
+        """Whether topic is subscribed itself or covered by a wildcard subscription."""
+        return topic in self.subscriptions or self._wildcards.resolve(topic)[0] is not None
+
+    def _add_subscriptions(self, topics):
+        self.subscriptions.update(topics)
+        for topic in topics:
+            if topic.endswith('#'):
+                self._wildcards.register(topic, topic)
+
+    def subscribe_many(self, topics, qos=0, chunk=200):
+        """
+        Subscribes to many topics at once sending up to chunk topics in one SUBSCRIBE packet.
+        Topics already covered by the subscriptions are skipped.
+        """
+        topics = [topic for topic in dict.fromkeys(topics) if not self.is_subscribed(topic)]
+        try:
+            for pos in range(0, len(topics), chunk):
+                part = topics[pos:pos + chunk]
+                result, mid = self.client.subscribe([(topic, qos) for topic in part])
+                if result != mqtt.MQTT_ERR_SUCCESS:
+                    raise ConnectionError(mqtt.error_string(result))
+                self._add_subscriptions(part)
+        except Exception as e:
+            log('Could not subscribe: ' + str(e), log_type='error')
+            return False
+        if topics:
+            log(f'Subscribed to {len(topics)} topics')
+        return True
+
+    def unsubscribe(self, topic):
+        """Unsubscribes from the topic if it was subscribed itself (topics covered by a wildcard are left alone)."""
+        if topic not in self.subscriptions:
+            return True
+        try:
+            self.client.unsubscribe(topic)
+        except Exception as e:
+            log('Could not unsubscribe: ' + str(e), log_type='error')
+            return False
+        self.subscriptions.discard(topic)
+        self._wildcards.unregister(topic)
+        log('Unsubscribed: ' + topic)
+        return True
+
     def check_for_messages(self):
         self.client.loop()
 
@@ -124,18 +262,20 @@ class Mqtt:
 
     def process_message(self, client, userdata, message):
         if message:
-            payload = message.payload.decode()
-            log(f' Got {payload} in {message.topic}', log_type='debug')
+            log('Got message', log_type='debug', topic=message.topic, payload=message.payload)
+            if self.recorder:
+                self.recorder.record(message.topic, message.payload)
 
             if self.external_handler:
-                self.external_handler.handle(topic=message.topic, payload=payload)
+                # the handler decodes payload with the codec of the device
+                self.external_handler.handle(topic=message.topic, payload=message.payload)
             else:
-                self.message_buffer.enqueue((message.topic, payload))
+                self.message_buffer.enqueue((message.topic, message.payload.decode()))
 
     def disconnect(self):
         self._client.disconnect()
         self.connected = False
-        print('Disconnected')
+        log('Disconnected', log_type='debug')
 
     def on_disconnect(self, client, userdata, rc=0):
         self.connected = False
@@ -143,6 +283,139 @@ class Mqtt:
         client.loop_stop()
 
 
+class Publisher:
+    """
+    Long-lived publisher for commands.
+    Keeps one or more connections to the broker open, each one with its own network loop thread,
+    so sending a command costs a PUBLISH instead of a full connect/publish/disconnect cycle.
+    Reconnection is left to paho's loop, which retries in the background.
+    Topics are pinned to connections, so commands to the same topic are never reordered.
+    """
+
+    def __init__(self, name, config=config, connections=1, qos=1, timeout=5):
+        mqtt_config = config.get('mqtt')
+        self.name = name
+        self.root = mqtt_config['object_name']
+        self.broker = mqtt_config['server']
+        self.qos = qos
+        self.timeout = timeout
+        self.started = False
+        self._lock = Lock()
+        self._clients = []
+        self._ready = []
+        for num in range(max(connections, 1)):
+            client = make_client(f'{self.name}_{num}', True, mqtt_config)
+            client.reconnect_delay_set(min_delay=1, max_delay=30)
+            ready = Event()
+            client.user_data_set(ready)
+            client.on_connect = self.on_connect
+            client.on_disconnect = self.on_disconnect
+            self._clients.append(client)
+            self._ready.append(ready)
+
+    @property
+    def connected(self):
+        return self.started and all(ready.is_set() for ready in self._ready)
+
+    def start(self):
+        """Starts network loops of all the connections. Connecting itself goes on in background."""
+        with self._lock:
+            if self.started:
+                return
+            for client in self._clients:
+                client.connect_async(self.broker)
+                client.loop_start()
+            self.started = True
+        log(f'Publisher {self.name} started with {len(self._clients)} connection(s) to {self.broker}')
+
+    def stop(self):
+        for client in self._clients:
+            client.disconnect()
+            client.loop_stop()
+        for ready in self._ready:
+            ready.clear()
+        self.started = False
+
+    def _slot(self, topic):
+        return shard_of(topic, len(self._clients))
+
+    def publish(self, topic: str, msg: str, retain=False, timeout=None):
+        """
+        Hands msg over to the connection that owns the topic, waiting for it to be ready up to timeout.
+        Returns paho's MQTTMessageInfo or None.
+        """
+        if not self.started:
+            self.start()
+        slot = self._slot(topic)
+        if not self._ready[slot].wait(timeout if timeout is not None else self.timeout):
+            log(f'Publisher connection {slot} is not ready, {topic} is not sent', log_type='error')
+            return None
+        return self._clients[slot].publish(topic, msg, qos=self.qos, retain=retain)
+
+    def wait(self, info, timeout=None) -> bool:
+        """Waits for the message to be acknowledged by broker (or written to the socket for QoS 0)."""
+        if info is None or info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_AGAIN):
+            return False
+        try:
+            info.wait_for_publish(timeout if timeout is not None else self.timeout)
+            return info.is_published()
+        except (RuntimeError, ValueError) as e:
+            log(f'Message {info.mid} was not published: {e}', log_type='error')
+            return False
+
+    def mqttsend(self, topic: str, msg: str, retain=False):
+        """Sends msg to topic and waits for completion. Same contract as Mqtt.mqttsend."""
+        log('Sending', log_type='debug', topic=topic, msg=msg)
+        try:
+            sent = self.wait(self.publish(topic, msg, retain=retain))
+        except Exception as e:
+            log('Error while sending: {}.'.format(e), log_type='error')
+            return False
+        if not sent:
+            log(f'Sending {msg} to {topic} is not confirmed', log_type='error')
+        return sent
+
+    def publish_many(self, items, timeout=None):
+        """
+        Sends (topic, msg, retain) items in one pipelined burst and then waits for all the acks together.
+        The whole burst takes at most timeout, items of a connection which is not ready fail at once.
+        Returns list of results in the order of items.
+        """
+        log('Sending %s messages...', len(items), log_type='debug')
+        deadline = monotonic() + (timeout if timeout is not None else self.timeout)
+        infos, down = [], set()
+        for topic, msg, retain in items:
+            slot = self._slot(topic)
+            if slot in down:
+                infos.append(None)
+                continue
+            try:
+                info = self.publish(topic, msg, retain=retain, timeout=max(deadline - monotonic(), 0))
+            except Exception as e:
+                log(f'Error while sending to {topic}: {e}.', log_type='error')
+                info = None
+            else:
+                if info is None:
+                    down.add(slot)
+            infos.append(info)
+        results = [self.wait(info, max(deadline - monotonic(), 0)) for info in infos]
+        if not all(results):
+            log(f'{results.count(False)} of {len(items)} messages are not confirmed', log_type='error')
+        return results
+
+    def on_connect(self, client, ready, flags, rc):
+        if rc == mqtt.MQTT_ERR_SUCCESS:
+            ready.set()
+            log(f'Publisher {self.name} connected to {self.broker}', log_type='debug')
+        else:
+            log(f'Publisher connection refused: {mqtt.connack_string(rc)}', log_type='error')
+
+    def on_disconnect(self, client, ready, rc=0):
+        ready.clear()
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            log(f'Publisher lost connection ({mqtt.error_string(rc)}), reconnecting...', log_type='warning')
+
+
 class Dumb:
 
     def __init__(self):
@@ -156,6 +429,18 @@ class Dumb:
         pass
         #print('Dumb would not subscribe')
 
+    def subscribe_many(self, topics, **kwargs):
+        return True
+
+    def unsubscribe(self, topic):
+        return True
+
+    def mqttsend(self, topic, msg, retain=False):
+        return True
+
+    def publish_many(self, items, **kwargs):
+        return [True] * len(items)
+
 
 #sender = Mqtt('syrabond_sender_' + str(uuid()), config='conf.json', clean_session=True)
 
@@ -1,48 +1,216 @@
+import atexit
+from threading import Lock
 from uuid import uuid4 as uuid
 from time import sleep
 
-from .common import log
-from .mqttsender import Mqtt
+from .codecs import codec_selector
+from .common import config, log, shard_of
+from .ingest import IngestPool
+from .mqttsender import Mqtt, Publisher, Queue
+from .routing import TopicRouter
+from .traffic import TrafficRecorder
+from .state_store import state_store
+from .write_buffer import state_writer
 
 
 class MessageHandler:
+    """
+    Routes incoming messages to resources and keeps the resources in sync with DB.
+    Resources are changed by the change listener thread while the network thread routes messages,
+    so the maps and the router are only touched under the lock (no DB or network calls under it).
+    """
 
-    def __init__(self):
+    # changes of these decide which channels of sensors are watched by automation
+    WATCHING = ('main.condition', 'main.regulator')
+
+    def __init__(self, workers=0, capacity=10000, overflow=Queue.DROP_OLDEST, collapse_threshold=0, shard=0, shards=1):
         self.resources = {}
+        self.topics = {}
+        self.router = TopicRouter()
+        self._lock = Lock()
         self.loaded = False
         self.models = []
+        self.listener = None
+        self.collapse_threshold = collapse_threshold
+        self.shard = shard
+        self.shards = shards
+        self.pool = IngestPool(self.process, workers, capacity, overflow) if workers else None
 
-    def load_resources(self, models: list):
+    def load_resources(self, models: list, subscribe=True):
         if not self.loaded:
             log('Loading resources...')
             self.models = models
-            self.update_resources()
+            self.update_resources(subscribe=subscribe)
             self.loaded = True
+            from .signals import subscribe_changes
+            subscribe_changes(self.on_change)
+            if self.pool:
+                self.pool.start()
+
+    def known(self):
+        """Snapshot of (uid, resource) pairs."""
+        with self._lock:
+            return list(self.resources.items())
 
-    def update_resources(self):
+    def update_resources(self, subscribe=True):
+        known = [uid for uid, _ in self.known()]
+        new = []
         for model in self.models:
-            qs = model.objects.exclude(uid__in=self.resources)
+            qs = model.objects.exclude(uid__in=known).select_related('facility')
             for obj in qs:
-                log(f'connecting {obj}')
-                obj.connect()
-                self.resources.update({obj.uid: obj})
+                if not self.owns(obj.uid):
+                    continue
+                log('connecting %s', obj, log_type='debug')
+                self.register(obj)
+                new.append(obj)
+        if subscribe and new:
+            self.listener.subscribe_many(self.subscription_topics(new))
 
-    def handle(self, topic=None, payload=None):
-        resource = None
-        topic_items = topic.split('/')
+    def owns(self, uid):
+        """
+        Whether the device belongs to the shard of this handler.
+        Listener processes split devices by hash of uid, so every device is handled by one process in order.
+        """
+        return self.shards <= 1 or shard_of(uid, self.shards) == self.shard
+
+    def subscription_topics(self, objs):
+        """
+        Topics to subscribe to for the objects.
+        Devices with standard topics are collapsed into one facility/type/# wildcard
+        if there are at least collapse_threshold of them (zero threshold disables collapsing).
+        Sharded listeners never collapse: a wildcard would bring them traffic of devices of other shards.
+        """
+        collapse = self.collapse_threshold and self.shards <= 1
+        topics, groups = [], {}
+        for obj in objs:
+            if not obj.topic:
+                log(f'Unable to connect {obj}, topic unknown.')
+            elif collapse and not obj.custom_topic:
+                groups.setdefault(f'{obj.facility.key}/{obj.type}/#', []).append(obj.topic)
+            else:
+                topics.append(obj.topic)
+        for wildcard, group in groups.items():
+            if len(group) >= self.collapse_threshold:
+                topics.append(wildcard)
+            else:
+                topics += group
+        return topics
+
+    def register(self, obj):
+        with self._lock:
+            self.resources.update({obj.uid: obj})
+            if obj.topic:
+                self.topics[obj.uid] = obj.topic
+                self.router.register(obj.topic, obj)
+        state_store.seed(obj.store_key, obj.state)
+
+    def unregister(self, uid, unsubscribe=True):
+        with self._lock:
+            obj = self.resources.pop(uid, None)
+            if obj is None:
+                return
+            topic = self.topics.pop(uid, None)
+            if topic:
+                self.router.unregister(topic)
+        if topic and unsubscribe and self.listener:
+            self.listener.unsubscribe(topic)
+        state_store.forget(obj.store_key)
+        codec_selector.forget(uid)
+        log('disconnected %s', obj, log_type='debug')
 
-        for pos, item in enumerate(topic_items):
-            if item in self.resources:
-                resource = self.resources[item]
-                break
+    def reload(self, model, objs):
+        """Re-registers the objects of the model reloaded from DB, subscribes to the new topics."""
+        model = self.model_of(model)
+        if model is None:
+            return
+        fresh = {obj.uid: obj for obj in model.objects.filter(pk__in=objs).select_related('facility')}
+        new = []
+        for uid in objs:
+            old_topic = self.topics.get(uid)
+            obj = fresh.get(uid) if self.owns(uid) else None
+            if obj is None or old_topic != obj.topic:
+                self.unregister(uid)
+            # settings may have a new codec
+            codec_selector.forget(uid)
+            if obj is not None:
+                if uid not in self.resources:
+                    new.append(obj)
+                self.register(obj)
+        if new and self.listener:
+            self.listener.subscribe_many(self.subscription_topics(new))
+
+    def model_of(self, label):
+        for model in self.models:
+            if model._meta.label_lower == label:
+                return model
+
+    def on_change(self, label, pk, action):
+        """Change notification: connects, reconnects or disconnects the resource changed."""
+        if label == 'main.facility':
+            for model in self.models:
+                uids = [uid for uid, obj in self.known() if isinstance(obj, model) and obj.facility_id == pk]
+                if uids:
+                    self.reload(model._meta.label_lower, uids)
+        elif label in self.WATCHING:
+            for _, obj in self.known():
+                obj.__dict__.pop('watched_channels', None)
+        elif action == 'delete':
+            self.unregister(pk)
+        elif self.model_of(label) is not None:
+            self.reload(label, [pk])
+
+    def resync(self):
+        """Catches up with changes possibly missed: connects new resources, disconnects deleted ones."""
+        known = self.known()
+        for model in self.models:
+            uids = [uid for uid, obj in known if isinstance(obj, model)]
+            existing = set(model.objects.filter(pk__in=uids).values_list('pk', flat=True))
+            for uid in uids:
+                if uid not in existing:
+                    self.unregister(uid)
+        self.update_resources()
+
+    def handle(self, topic=None, payload=None):
+        with self._lock:
+            resource, channel = self.router.resolve(topic)
 
         if resource:
-            resource.refresh_from_db()
-            if pos + 1 < len(topic_items):
-                channel = '.'.join(topic_items[pos + 1:])
-                resource.update_state(payload, channel)
+            codec = codec_selector.select(resource, topic)
+            if self.pool:
+                self.pool.submit(resource.uid, resource, payload, channel, codec)
             else:
-                resource.update_state(payload)
+                self.process(resource, payload, channel, codec)
+
+    def stats(self):
+        return {
+            'shard': f'{self.shard + 1}/{self.shards}',
+            'resources': len(self.resources),
+            'state_store': len(state_store),
+            'state_writer': state_writer.stats(),
+            'ingest': self.pool.stats() if self.pool else None
+        }
+
+    def process(self, resource, payload, channel=None, codec=None):
+        if codec:
+            try:
+                payload = codec(memoryview(payload) if isinstance(payload, bytes) else payload)
+            except Exception as e:
+                log(f'Unable to decode payload of {resource.uid}: {e}', log_type='error')
+                return
+        # the state store is authoritative, DB may lag behind because of coalesced writes
+        state = state_store.snapshot(resource.store_key)
+        if state is None:
+            resource.refresh_from_db()
+        else:
+            resource.state = state
+        if channel:
+            changed = resource.update_state(payload, channel)
+        else:
+            changed = resource.update_state(payload)
+        if changed and self.shards > 1 and resource.state_is_urgent(changed):
+            # automation runs in the background daemon, urgent state is already in DB
+            from .signals import notify_state
+            notify_state(resource, changed)
 
 
 
@@ -54,6 +222,30 @@ class Comm:
     }
 
 
-mqtt_sender = Mqtt('syrabond_sender_' + str(uuid()), clean_session=True)
+publisher_config = config.get('mqtt', {}).get('publisher', {})
+if publisher_config.get('persistent'):
+    mqtt_sender = Publisher(
+        'syrabond_sender_' + str(uuid()),
+        connections=publisher_config.get('connections', 1),
+        qos=publisher_config.get('qos', 1),
+        timeout=publisher_config.get('timeout', 5)
+    )
+else:
+    mqtt_sender = Mqtt('syrabond_sender_' + str(uuid()), clean_session=True)
 sleep(0.01)
-mqtt_listener = Mqtt('syrabond_automation_' + str(uuid()), clean_session=False, handler=MessageHandler())
+ingest_config = config.get('ingest', {})
+mqtt_listener = Mqtt(
+    'syrabond_automation_' + str(uuid()),
+    clean_session=False,
+    handler=MessageHandler(
+        workers=ingest_config.get('workers', 0),
+        capacity=ingest_config.get('capacity', 10000),
+        overflow=ingest_config.get('overflow', Queue.DROP_OLDEST),
+        collapse_threshold=config.get('mqtt', {}).get('collapse_threshold', 0),
+        shards=config.get('mqtt', {}).get('shards', 1)
+    )
+)
+mqtt_listener.external_handler.listener = mqtt_listener
+if config.get('mqtt', {}).get('record'):
+    mqtt_listener.recorder = TrafficRecorder(config['mqtt']['record'])
+    atexit.register(mqtt_listener.recorder.close)
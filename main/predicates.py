@@ -0,0 +1,51 @@
+"""Typed predicates of conditions compiled once instead of eval() on every check."""
+import operator
+from functools import lru_cache
+
+OPERATORS = {
+    '>': operator.gt,
+    '<': operator.lt,
+    '==': operator.eq,
+    '!=': operator.ne
+}
+
+
+def as_number(value):
+    """float of the value if it is a number or a string of a number, None otherwise."""
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+@lru_cache(maxsize=4096)
+def compile_predicate(comparison: str, expected: str):
+    """
+    Returns predicate(value) -> bool comparing the value with the expected one.
+    Comparison is numeric when both sides are numbers, case-insensitive of strings otherwise
+    (the way it has always been for non-numeric states like on/off).
+    A value which is not a number (missing reading, None) never matches < or > of a numeric threshold,
+    == and != compare it as a string.
+    """
+    compare = OPERATORS.get(comparison)
+    if compare is None:
+        raise ValueError(f'Unknown comparison {comparison}')
+    text = str(expected).lower()
+    number = as_number(expected)
+    ordering = comparison in ('<', '>')
+
+    if number is None:
+        def predicate(value):
+            return compare(str(value).lower(), text)
+    else:
+        def predicate(value):
+            value_number = as_number(value)
+            if value_number is not None:
+                return compare(value_number, number)
+            if ordering:
+                return False
+            return compare(str(value).lower(), text)
+
+    return predicate
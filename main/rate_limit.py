@@ -0,0 +1,131 @@
+"""Rate limiting of automated commands to devices."""
+import fcntl
+import mmap
+import os
+import struct
+from threading import Lock
+from time import time
+from zlib import crc32
+
+from .common import config, log
+
+
+class SharedTable:
+    """
+    Bucket states in a shared memory file (/dev/shm), so every process of the daemon sees the same buckets.
+    Open addressing table of (key hash, tokens, stamp) slots, access is serialized with flock.
+    """
+
+    SLOT = struct.Struct('<Qdd')
+
+    def __init__(self, name, slots=4096):
+        self.slots = slots
+        path = name if os.path.isabs(name) else os.path.join('/dev/shm', name)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self.SLOT.size * slots
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+
+    @staticmethod
+    def _hash(key):
+        # zero marks an empty slot
+        return crc32(key.encode()) | 1 << 32
+
+    def update(self, key, apply):
+        """Calls apply(tokens, stamp) -> (tokens, stamp) on the bucket of the key under the lock."""
+        wanted = self._hash(key)
+        start = wanted % self.slots
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            for probe in range(self.slots):
+                offset = (start + probe) % self.slots * self.SLOT.size
+                found, tokens, stamp = self.SLOT.unpack_from(self.map, offset)
+                if found in (0, wanted):
+                    tokens, stamp = apply(tokens, stamp) if found else apply(None, None)
+                    self.SLOT.pack_into(self.map, offset, wanted, tokens, stamp)
+                    return True
+            return False
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+class RateLimiter:
+    """
+    Token bucket per device for indirect commands: up to burst commands, refilled at burst per `per` seconds.
+    Policies come from switch settings['rate_limit'] or config rate_limit.switches[uid] first.
+    Otherwise indirect commands of users (REST) get rate_limit.default, one command a minute
+    by default like the old freeze_until debounce.
+    Commands of automation rules are not limited (as they never were) unless a policy is configured
+    for the switch, for the rule in rate_limit.rules ('behavior:<pk>', 'regulator:<pk>')
+    or for all of them in rate_limit.automation. Buckets are per switch whatever policy applies.
+    Buckets live in memory of the process or in shared memory when rate_limit.shared names the table.
+    """
+
+    DEFAULT = {'burst': 1, 'per': 60}
+
+    def __init__(self, default=None, switches=None, rules=None, automation=None, shared=None, slots=4096):
+        self.default = {**self.DEFAULT, **(default or {})}
+        self.switches = switches or {}
+        self.rules = rules or {}
+        self.automation = automation
+        self.buckets = {}
+        self.table = None
+        self.allowed = 0
+        self.limited = 0
+        self._lock = Lock()
+        if shared:
+            try:
+                self.table = SharedTable(shared, slots)
+            except OSError as e:
+                log(f'Unable to open shared rate limiter table {shared}: {e}', log_type='error')
+
+    def policy(self, switch, rule=None):
+        """Policy of commands to the switch sent by the rule (by a user if None), None means no limit."""
+        settings = switch.settings if isinstance(switch.settings, dict) else {}
+        policy = settings.get('rate_limit') or self.switches.get(switch.uid)
+        if rule is not None and not policy:
+            policy = self.rules.get(f'{rule._meta.model_name}:{rule.pk}') or self.automation
+            if not policy:
+                return None
+        return {**self.default, **policy} if policy else self.default
+
+    @staticmethod
+    def _take(policy, now):
+        burst, per = policy['burst'], policy['per']
+        decision = []
+
+        def apply(tokens, stamp):
+            if tokens is None:
+                tokens, stamp = burst, now
+            tokens = min(burst, tokens + (now - stamp) * burst / per) if per else burst
+            decision.append(tokens >= 1)
+            return (tokens - 1 if tokens >= 1 else tokens), now
+
+        return apply, decision
+
+    def allow(self, key, policy) -> bool:
+        """Takes a token from the bucket of the key. False means the command must not be sent."""
+        if policy is None:
+            return True
+        apply, decision = self._take(policy, time())
+        if not (self.table and self.table.update(key, apply)):
+            with self._lock:
+                self.buckets[key] = apply(*self.buckets.get(key, (None, None)))
+        with self._lock:
+            if decision[0]:
+                self.allowed += 1
+            else:
+                self.limited += 1
+        return decision[0]
+
+    def stats(self):
+        return {
+            'allowed': self.allowed,
+            'limited': self.limited,
+            'buckets': len(self.buckets),
+            'shared': bool(self.table)
+        }
+
+
+rate_limiter = RateLimiter(**config.get('rate_limit', {}))
@@ -0,0 +1,79 @@
+"""Routing of incoming MQTT topics to resources."""
+
+
+class _Node:
+
+    __slots__ = ('children', 'resource')
+
+    def __init__(self):
+        self.children = {}
+        self.resource = None
+
+
+class TopicRouter:
+    """
+    Precompiled routing index of subscribed topics, a trie keyed by topic levels (facility/type/uid...).
+    Resolves a topic to (resource, channel) in one walk over its levels.
+    Registered topic matches as a prefix: levels below it become the channel joined by dots,
+    the same way a trailing '#' does. '+' matches exactly one level.
+    Exact levels win over '+', deeper registered topics win over shallower ones.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+        self.topics = {}
+
+    def __len__(self):
+        return len(self.topics)
+
+    @staticmethod
+    def _levels(topic: str) -> list:
+        levels = topic.split('/')
+        if levels[-1] == '#':
+            levels.pop()
+        return levels
+
+    def register(self, topic: str, resource):
+        node = self.root
+        for level in self._levels(topic):
+            node = node.children.setdefault(level, _Node())
+        node.resource = resource
+        self.topics[topic] = resource
+
+    def unregister(self, topic: str):
+        if self.topics.pop(topic, None) is None:
+            return
+        path = [self.root]
+        levels = self._levels(topic)
+        for level in levels:
+            path.append(path[-1].children[level])
+        path[-1].resource = None
+        # prune the branch left empty
+        for pos in range(len(levels), 0, -1):
+            if path[pos].children or path[pos].resource is not None:
+                break
+            del path[pos - 1].children[levels[pos - 1]]
+
+    def _match(self, node, levels, pos):
+        if pos < len(levels):
+            child = node.children.get(levels[pos])
+            if child is not None:
+                found = self._match(child, levels, pos + 1)
+                if found:
+                    return found
+            child = node.children.get('+')
+            if child is not None:
+                found = self._match(child, levels, pos + 1)
+                if found:
+                    return found
+        if node.resource is not None:
+            return node.resource, pos
+
+    def resolve(self, topic: str):
+        """Returns (resource, channel) for the topic or (None, None) if nothing is subscribed to it."""
+        levels = topic.split('/')
+        found = self._match(self.root, levels, 0)
+        if not found:
+            return None, None
+        resource, pos = found
+        return resource, '.'.join(levels[pos:]) or None
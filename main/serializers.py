@@ -16,6 +16,8 @@ class SwitchSerializer(serializers.ModelSerializer):
 
 class SensorSerializer(serializers.ModelSerializer):
 
+    state = serializers.JSONField(source='live_state', read_only=True)
+
     class Meta:
         fields = ('title', 'uid', 'state')
 
@@ -0,0 +1,165 @@
+"""
+Change notifications of the models automation and ingest depend on.
+Changes are dispatched to in-process subscribers right after commit and broadcast to other processes
+with PostgreSQL NOTIFY; ChangeListener receives them in the background daemon.
+State changes made by listener shards are broadcast the same way, so automation of other processes sees them.
+"""
+import json
+import select
+from threading import Thread
+from time import sleep
+from uuid import uuid4 as uuid
+
+from django.db import connection, connections, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .common import log
+from .models import Behavior, Button, Condition, Facility, Regulator, Scenario, Sensor, Switch, VirtualDevice
+
+NOTIFY_CHANNEL = 'syrabond_changes'
+# saves which change only these fields are device state, not configuration
+STATE_FIELDS = {'state', 'updated_at', 'extra', 'service_data'}
+
+origin = uuid().hex
+subscribers = []
+state_subscribers = []
+
+
+def subscribe_changes(callback):
+    """callback(label, pk, action) is called on every change, label is like 'main.switch', action is save or delete."""
+    if callback not in subscribers:
+        subscribers.append(callback)
+
+
+def dispatch(label, pk, action):
+    for callback in list(subscribers):
+        try:
+            callback(label, pk, action)
+        except Exception as e:
+            log(f'Change subscriber {callback} failed on {label} {pk}: {e}', log_type='error')
+
+
+def notify_change(instance, action):
+    label, pk = instance._meta.label_lower, instance.pk
+
+    def send():
+        dispatch(label, pk, action)
+        if connection.vendor == 'postgresql':
+            payload = json.dumps({'label': label, 'pk': pk, 'action': action, 'origin': origin})
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_notify(%s, %s)', [NOTIFY_CHANNEL, payload])
+
+    transaction.on_commit(send)
+
+
+def subscribe_states(callback):
+    """callback(key, channels) is called on state changes of devices made by other processes."""
+    if callback not in state_subscribers:
+        state_subscribers.append(callback)
+
+
+def dispatch_state(key, channels):
+    for callback in list(state_subscribers):
+        try:
+            callback(key, channels)
+        except Exception as e:
+            log(f'State subscriber {callback} failed on {key}: {e}', log_type='error')
+
+
+def notify_state(instance, channels):
+    """Broadcasts the state change of the device to other processes, the state must already be written to DB."""
+    if connection.vendor != 'postgresql':
+        return
+    payload = json.dumps({'key': instance.store_key, 'channels': channels, 'action': 'state', 'origin': origin})
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, %s)', [NOTIFY_CHANNEL, payload])
+
+
+TRACKED = (Switch, Sensor, Button, Facility, VirtualDevice, Condition, Behavior, Regulator, Scenario)
+
+
+@receiver(post_save)
+def saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    if sender not in TRACKED or raw or update_fields and set(update_fields) <= STATE_FIELDS:
+        return
+    notify_change(instance, 'save')
+
+
+@receiver(post_delete)
+def deleted(sender, instance, **kwargs):
+    if sender in TRACKED:
+        notify_change(instance, 'delete')
+
+
+@receiver(m2m_changed, sender=Behavior.conditions_on.through)
+@receiver(m2m_changed, sender=Behavior.conditions_off.through)
+@receiver(m2m_changed, sender=Scenario.conditions.through)
+def conditions_changed(sender, instance, action, reverse, pk_set=None, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse and pk_set:
+        # conditions.behaviors_on.add(...) and alike, the rules themselves have changed
+        model = Scenario if sender is Scenario.conditions.through else Behavior
+        for rule in model.objects.filter(pk__in=pk_set):
+            notify_change(rule, 'save')
+    else:
+        notify_change(instance, 'save')
+
+
+class ChangeListener:
+    """
+    LISTENs for change notifications of other processes on its own DB connection and dispatches them.
+    Callbacks of on_resync are called after every (re)connect: notifications sent while
+    the listener was not connected are lost, so subscribers have to catch up.
+    """
+
+    def __init__(self, timeout=5, reconnect_delay=5):
+        self.timeout = timeout
+        self.reconnect_delay = reconnect_delay
+        self.on_resync = []
+        self.running = False
+
+    def start(self):
+        if connection.vendor != 'postgresql':
+            log('Change notifications across processes need PostgreSQL', log_type='warning')
+            return
+        self.running = True
+        Thread(target=self.listen, name='change-listener', daemon=True).start()
+
+    def listen(self):
+        while self.running:
+            try:
+                db = connections['default']
+                conn = db.get_new_connection(db.get_connection_params())
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f'LISTEN {NOTIFY_CHANNEL}')
+                log('Listening to change notifications')
+                for callback in self.on_resync:
+                    callback()
+                self.receive(conn)
+            except Exception as e:
+                log(f'Change listener failed: {e}', log_type='error')
+            sleep(self.reconnect_delay)
+
+    def receive(self, conn):
+        try:
+            while self.running:
+                if select.select([conn], [], [], self.timeout) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    change = json.loads(notify.payload)
+                    if change.get('origin') == origin:
+                        continue
+                    if change['action'] == 'state':
+                        dispatch_state(change['key'], change['channels'])
+                    else:
+                        dispatch(change['label'], change['pk'], change['action'])
+        finally:
+            conn.close()
+
+
+change_listener = ChangeListener()
@@ -7,5 +7,7 @@ class JsonToChannels:
         pass
 
     def __call__(self, *args, raw_state=None, **kwargs):
+        if isinstance(raw_state, dict):
+            return raw_state
         if raw_state:
             return json.loads(raw_state)
@@ -0,0 +1,85 @@
+from threading import Lock
+
+from .common import log
+
+
+class StateStore:
+    """
+    Process-wide authoritative store of device state keyed by uid (store key) and channel.
+    State dicts are never changed in place: every update replaces the dict of the device,
+    so a dict returned by view() is a consistent read-only snapshot.
+    Every update bumps the version of the device and notifies subscribers
+    with the key, the list of changed channels and the new version.
+    """
+
+    def __init__(self):
+        self._states = {}
+        self._versions = {}
+        self._subscribers = []
+        self._lock = Lock()
+
+    def __contains__(self, key):
+        return key in self._states
+
+    def __len__(self):
+        return len(self._states)
+
+    def seed(self, key, state: dict):
+        """Puts the state persisted in DB to the store unless the store already knows the device."""
+        with self._lock:
+            if key not in self._states:
+                self._states[key] = dict(state or {})
+                self._versions[key] = 0
+
+    def put(self, key, state: dict) -> list:
+        """Replaces the state of the device. Returns channels which have changed."""
+        state = dict(state or {})
+        with self._lock:
+            current = self._states.get(key, {})
+            changed = [channel for channel, value in state.items() if current.get(channel, self) != value]
+            changed += [channel for channel in current if channel not in state]
+            self._states[key] = state
+            version = self._versions.get(key, 0) + 1 if changed else self._versions.get(key, 0)
+            self._versions[key] = version
+            subscribers = list(self._subscribers) if changed else ()
+        for callback in subscribers:
+            try:
+                callback(key, changed, version)
+            except Exception as e:
+                log(f'State subscriber {callback} failed on {key}: {e}', log_type='error')
+        return changed
+
+    def forget(self, key):
+        with self._lock:
+            self._states.pop(key, None)
+            self._versions.pop(key, None)
+
+    def view(self, key):
+        """Current state dict of the device (do not modify it) or None if the device is unknown."""
+        return self._states.get(key)
+
+    def snapshot(self, key):
+        state = self._states.get(key)
+        return dict(state) if state is not None else None
+
+    def get(self, key, channel='state', default=None):
+        return self._states.get(key, {}).get(channel, default)
+
+    def version(self, key):
+        return self._versions.get(key)
+
+    def channels(self, key):
+        return list(self._states.get(key, ()))
+
+    def subscribe(self, callback):
+        """callback(key, channels, version) is called after every update which changes something."""
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+
+state_store = StateStore()
@@ -0,0 +1,362 @@
+import logging
+from queue import Queue
+from threading import Event
+from time import monotonic, sleep
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase
+
+from .automation import rule_jobs
+from .common import LogWriter
+from .dependencies import DependencyIndex
+from .executor import TickExecutor
+from .evaluation import EvaluationContext
+from .models import Action, Behavior, Condition, ConnectedResource, Facility, Regulator, Sensor, Switch
+from .loopback import LoopbackBroker, LoopbackClient
+from .mqttsender import Dumb, Publisher
+from .predicates import compile_predicate
+from .rate_limit import RateLimiter
+from .routing import TopicRouter
+
+
+class PredicateTest(SimpleTestCase):
+
+    def test_numeric(self):
+        self.assertTrue(compile_predicate('>', '10')(25))
+        self.assertTrue(compile_predicate('>', '10')('25.5'))
+        self.assertFalse(compile_predicate('>', '10')(9))
+        self.assertTrue(compile_predicate('<', '10')('9'))
+        self.assertTrue(compile_predicate('==', '10')('10.0'))
+        self.assertFalse(compile_predicate('!=', '10')(10))
+
+    def test_numeric_not_as_strings(self):
+        # '9' > '10' as strings
+        self.assertFalse(compile_predicate('>', '10')('9'))
+        self.assertTrue(compile_predicate('<', '10')(9))
+
+    def test_string(self):
+        self.assertTrue(compile_predicate('==', 'on')('ON'))
+        self.assertFalse(compile_predicate('==', 'on')('off'))
+        self.assertTrue(compile_predicate('!=', 'on')('off'))
+
+    def test_none_never_matches_threshold(self):
+        self.assertFalse(compile_predicate('>', '10')(None))
+        self.assertFalse(compile_predicate('<', '10')(None))
+        self.assertFalse(compile_predicate('==', '10')(None))
+        self.assertTrue(compile_predicate('!=', '10')(None))
+
+    def test_not_a_number_never_matches_threshold(self):
+        self.assertFalse(compile_predicate('>', '10')('unavailable'))
+        self.assertFalse(compile_predicate('<', '10')('unavailable'))
+
+    def test_none_as_string(self):
+        self.assertTrue(compile_predicate('==', 'none')(None))
+        self.assertFalse(compile_predicate('!=', 'none')(None))
+
+    def test_bool(self):
+        self.assertTrue(compile_predicate('==', 'true')(True))
+        self.assertFalse(compile_predicate('==', 'true')(False))
+        # bool is not a number, so it does not pass a numeric threshold
+        self.assertFalse(compile_predicate('>', '0')(True))
+        self.assertFalse(compile_predicate('==', '1')(True))
+
+    def test_unknown_comparison(self):
+        with self.assertRaises(ValueError):
+            compile_predicate('>=', '10')
+
+
+class TopicRouterTest(SimpleTestCase):
+
+    def setUp(self):
+        self.router = TopicRouter()
+
+    def test_exact_wins_over_wildcard(self):
+        self.router.register('home/+/t1', 'any')
+        self.router.register('home/sensor/t1', 'sensor')
+        self.assertEqual(self.router.resolve('home/sensor/t1'), ('sensor', None))
+        self.assertEqual(self.router.resolve('home/switch/t1'), ('any', None))
+
+    def test_plus_matches_one_level(self):
+        self.router.register('home/+/t1', 'any')
+        self.assertEqual(self.router.resolve('home/sensor/t1'), ('any', None))
+        self.assertEqual(self.router.resolve('home/a/b/t1'), (None, None))
+
+    def test_levels_below_are_channel(self):
+        self.router.register('home/sensor/t1/#', 'sensor')
+        self.assertEqual(self.router.resolve('home/sensor/t1/temp/raw'), ('sensor', 'temp.raw'))
+        self.assertEqual(self.router.resolve('home/sensor'), (None, None))
+
+    def test_deeper_wins(self):
+        self.router.register('home/sensor', 'all')
+        self.router.register('home/sensor/t1', 'sensor')
+        self.assertEqual(self.router.resolve('home/sensor/t1/temp'), ('sensor', 'temp'))
+        self.assertEqual(self.router.resolve('home/sensor/t2/temp'), ('all', 't2.temp'))
+
+    def test_unregister(self):
+        self.router.register('home/+/t1', 'any')
+        self.router.register('home/sensor/t1', 'sensor')
+        self.router.unregister('home/sensor/t1')
+        self.assertEqual(self.router.resolve('home/sensor/t1'), ('any', None))
+        self.router.unregister('home/+/t1')
+        self.assertEqual(self.router.resolve('home/sensor/t1'), (None, None))
+        self.assertEqual(self.router.root.children, {})
+        self.assertEqual(len(self.router), 0)
+
+    def test_uid_as_level_of_another_topic(self):
+        # scan of levels for a known uid routed these to the device 'home' or 'sw1'
+        self.router.register('garden/switch/home', 'home')
+        self.router.register('home/switch/sw1', 'sw1')
+        self.router.register('home/sensor/t1', 't1')
+        self.assertEqual(self.router.resolve('home/sensor/t1'), ('t1', None))
+        self.assertEqual(self.router.resolve('home/sensor/t1/sw1'), ('t1', 'sw1'))
+        self.assertEqual(self.router.resolve('home/switch/sw1'), ('sw1', None))
+
+
+class RecordingSender(Dumb):
+
+    def __init__(self):
+        super().__init__()
+        self.bursts = []
+
+    def mqttsend(self, topic, msg, retain=False):
+        self.bursts.append([(topic, msg)])
+        return True
+
+    def publish_many(self, items, **kwargs):
+        self.bursts.append([(topic, msg) for topic, msg, _ in items])
+        return [True] * len(items)
+
+
+class ActionTest(TestCase):
+
+    def setUp(self):
+        self.sender = RecordingSender()
+        sender = patch.object(ConnectedResource, 'sender', self.sender)
+        sender.start()
+        self.addCleanup(sender.stop)
+        facility = Facility.objects.create(title='home', key='home')
+        self.a = Switch.objects.create(uid='a', title='a', facility=facility)
+        self.b = Switch.objects.create(uid='b', title='b', facility=facility)
+
+    def test_order_is_kept(self):
+        Action.do_many([Action(switch=self.a, state='on'), Action(switch=self.a, state='off')])
+        self.assertEqual(self.sender.bursts, [[('home/switch/a', 'on')], [('home/switch/a', 'off')]])
+
+    def test_consecutive_commands_in_one_burst(self):
+        Action.do_many([
+            Action(switch=self.a, state='on'), Action(switch=self.b, state='on'), Action(switch=self.b, state='off')])
+        self.assertEqual(
+            self.sender.bursts, [[('home/switch/a', 'on'), ('home/switch/b', 'on')], [('home/switch/b', 'off')]])
+
+
+class RegulatorTest(TestCase):
+
+    def setUp(self):
+        sender = patch.object(ConnectedResource, 'sender', RecordingSender())
+        sender.start()
+        self.addCleanup(sender.stop)
+        facility = Facility.objects.create(title='home', key='home')
+        for num in range(20):
+            sensor = Sensor.objects.create(uid=f'temp{num}', title='temp', facility=facility, state={'temp': 10})
+            regulator = Regulator.objects.create(sensor=sensor, channel='temp', lower_bond=18, upper_bond=22)
+            for pos in range(2):
+                Switch.objects.create(
+                    uid=f'heater{num}_{pos}', title='heater', facility=facility, controlled=True,
+                    regulator=regulator, state={'state': 'off'})
+
+    def test_engage_all_queries(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(Regulator.engage_all(), (40, 0))
+
+    def test_engage_all_of_loaded_regulators_queries(self):
+        # regulators kept by the dependency index, state of sensors and switches is read once for all of them
+        regulators = list(DependencyIndex._queryset(Regulator))
+        Switch.objects.update(state={'state': 'on'})
+        with self.assertNumQueries(2):
+            self.assertEqual(Regulator.engage_all(regulators), (0, 0))
+
+    def test_rule_jobs_burst(self):
+        regulators = list(DependencyIndex._queryset(Regulator))
+        with self.assertNumQueries(1):
+            jobs = rule_jobs(regulators, EvaluationContext())
+        self.assertEqual(len(jobs), 1)
+        name, keys, engage = jobs[0]
+        self.assertEqual(name, 'main.regulator')
+        self.assertEqual(len(keys), 40)
+        with self.assertNumQueries(1):
+            self.assertEqual(engage(), (40, 0))
+
+
+class TickExecutorTest(SimpleTestCase):
+
+    def setUp(self):
+        self.executor = TickExecutor(workers=2, deadline=0.1)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_waiting_job_does_not_hold_a_worker(self):
+        release, done = Event(), {name: Event() for name in ('slow', 'next', 's2', 's3')}
+        started = []
+
+        def job(name, block=False):
+            def func():
+                started.append(name)
+                if block:
+                    release.wait(5)
+                done[name].set()
+            return func
+
+        self.executor.run([
+            ('slow', ['s1'], job('slow', block=True)),
+            ('next', ['s1'], job('next')),
+            ('s2', ['s2'], job('s2')),
+            ('s3', ['s3'], job('s3'))
+        ])
+        # the slow job and the one waiting for its switch take one worker, not both
+        self.assertTrue(done['s2'].wait(1))
+        self.assertTrue(done['s3'].wait(1))
+        self.assertNotIn('next', started)
+        release.set()
+        self.assertTrue(done['next'].wait(1))
+        self.assertLess(started.index('slow'), started.index('next'))
+
+    def test_rerun_is_coalesced(self):
+        release, calls = Event(), []
+
+        def job(version):
+            def func():
+                calls.append(version)
+                release.wait(5)
+            return func
+
+        self.executor.run([('rule', ['s1'], job(1))])
+        self.executor.run([('rule', ['s1'], job(2))])
+        self.executor.run([('rule', ['s1'], job(3))])
+        release.set()
+        for _ in range(100):
+            if not self.executor.running:
+                break
+            sleep(0.01)
+        self.assertEqual(calls, [1, 3])
+        self.assertEqual(self.executor.stats()['skipped'], 2)
+
+
+class PublisherTest(SimpleTestCase):
+
+    def test_burst_is_bounded_by_timeout(self):
+        config = {'mqtt': {'transport': 'loopback', 'object_name': 'home', 'server': 'broker', 'user': '', 'password': ''}}
+        publisher = Publisher('test', config=config, connections=2, timeout=5)
+        # no network loops: connections never become ready
+        publisher.started = True
+        started = monotonic()
+        results = publisher.publish_many([(f'home/switch/s{num}', 'off', True) for num in range(6)], timeout=0.5)
+        self.assertLess(monotonic() - started, 1.5)
+        self.assertEqual(results, [False] * 6)
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class LogWriterTest(SimpleTestCase):
+
+    def setUp(self):
+        self.handler = ListHandler()
+        self.writer = LogWriter(Queue(), self.handler, burst=5, interval=60)
+
+    def write(self, msg, **fields):
+        self.writer.handle(logging.makeLogRecord({'msg': msg, 'levelno': logging.DEBUG, 'fields': fields}))
+
+    def test_identical_lines_are_folded(self):
+        for _ in range(8):
+            self.write('Got message', topic='home/sensor/t1')
+        self.assertEqual(len(self.handler.records), 5)
+
+    def test_fields_make_lines_distinct(self):
+        for num in range(8):
+            self.write('Got message', topic=f'home/sensor/t{num}')
+        self.assertEqual(len(self.handler.records), 8)
+
+
+class RateLimiterTest(SimpleTestCase):
+
+    def setUp(self):
+        self.switch = Switch(uid='lamp', state={'state': 'off'})
+        self.behavior = Behavior(pk=3)
+
+    def test_users_are_limited_by_default(self):
+        limiter = RateLimiter()
+        policy = limiter.policy(self.switch)
+        self.assertEqual(policy, RateLimiter.DEFAULT)
+        self.assertTrue(limiter.allow('lamp', policy))
+        self.assertFalse(limiter.allow('lamp', policy))
+
+    def test_automation_is_not_limited_by_default(self):
+        limiter = RateLimiter()
+        self.assertIsNone(limiter.policy(self.switch, self.behavior))
+        self.assertTrue(all(limiter.allow('lamp', None) for _ in range(10)))
+
+    def test_rule_policy(self):
+        limiter = RateLimiter(rules={'behavior:3': {'burst': 2}}, automation={'burst': 5})
+        self.assertEqual(limiter.policy(self.switch, self.behavior), {'burst': 2, 'per': 60})
+        self.assertEqual(limiter.policy(self.switch, Behavior(pk=4)), {'burst': 5, 'per': 60})
+
+    def test_switch_policy_goes_first(self):
+        limiter = RateLimiter(rules={'behavior:3': {'burst': 2}})
+        self.switch.settings = {'rate_limit': {'burst': 10, 'per': 1}}
+        self.assertEqual(limiter.policy(self.switch, self.behavior), {'burst': 10, 'per': 1})
+
+
+class BehaviorTest(TestCase):
+
+    def setUp(self):
+        self.sender = RecordingSender()
+        sender = patch.object(ConnectedResource, 'sender', self.sender)
+        sender.start()
+        self.addCleanup(sender.stop)
+        facility = Facility.objects.create(title='home', key='home')
+        self.sensor = Sensor.objects.create(uid='bt1', title='temp', facility=facility, state={'temp': 25})
+        self.behavior = Behavior.objects.create(title='heat')
+        self.behavior.conditions_on.add(
+            Condition.objects.create(sensor=self.sensor, channel='temp', comparison='>', state='10'))
+        self.behavior.conditions_off.add(
+            Condition.objects.create(sensor=self.sensor, channel='temp', comparison='<', state='5'))
+        self.switch = Switch.objects.create(
+            uid='bs1', title='fan', facility=facility, controlled=True, behavior=self.behavior, state={'state': 'off'})
+
+    def test_quick_reversal_is_sent(self):
+        self.behavior.engage(EvaluationContext())
+        Sensor.objects.filter(pk='bt1').update(state={'temp': 3})
+        Switch.objects.filter(pk='bs1').update(state={'state': 'on'})
+        self.behavior.engage(EvaluationContext())
+        self.assertEqual(self.sender.bursts, [[('home/switch/bs1', 'on')], [('home/switch/bs1', 'off')]])
+
+
+class LoopbackClientTest(SimpleTestCase):
+
+    def test_connection_events_without_loop_are_not_queued(self):
+        client = LoopbackClient('sender', broker=LoopbackBroker())
+        events = []
+        client.on_connect = lambda *args: events.append('connect')
+        client.on_disconnect = lambda *args: events.append('disconnect')
+        for _ in range(1000):
+            client.connect()
+            client.publish('home/switch/lamp', 'on')
+            client.disconnect()
+        self.assertEqual(len(client._inbox), 0)
+        self.assertEqual(events[:2], ['connect', 'disconnect'])
+        self.assertEqual(len(events), 2000)
+
+    def test_connection_events_with_loop(self):
+        client = LoopbackClient('publisher', broker=LoopbackBroker())
+        connected = Event()
+        client.on_connect = lambda *args: connected.set()
+        client.connect_async('broker')
+        client.loop_start()
+        self.addCleanup(client.loop_stop)
+        self.assertTrue(connected.wait(1))
@@ -0,0 +1,45 @@
+"""Recording of MQTT traffic received by the listener and reading it back for replay."""
+import struct
+from threading import Lock
+from time import time
+
+RECORD = struct.Struct('<dHI')
+
+
+class TrafficRecorder:
+    """
+    Appends every received message to a compact binary file:
+    a record is timestamp (double), topic length (ushort), payload length (uint), topic, payload.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.file = open(file_name, 'ab', buffering=1 << 16)
+        self.recorded = 0
+        self._lock = Lock()
+
+    def record(self, topic: str, payload: bytes, timestamp=None):
+        topic = topic.encode()
+        with self._lock:
+            self.file.write(RECORD.pack(timestamp or time(), len(topic), len(payload)) + topic + payload)
+            self.recorded += 1
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+
+def read_traffic(file_name):
+    """Yields (timestamp, topic, payload) of recorded messages."""
+    with open(file_name, 'rb') as f:
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, topic_length, payload_length = RECORD.unpack(header)
+            topic = f.read(topic_length).decode()
+            payload = f.read(payload_length)
+            if len(payload) < payload_length:
+                # the last record was cut off while being written
+                return
+            yield timestamp, topic, payload
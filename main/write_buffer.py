@@ -0,0 +1,136 @@
+import atexit
+import json
+from copy import copy
+from threading import Lock, Thread
+from time import sleep
+
+from django.db.models import F, Func, JSONField, Value
+from django.utils import timezone
+
+from .common import config, log
+
+
+class JSONBPatch(Func):
+    """
+    PostgreSQL ``field || patch``: merges top-level keys of patch into the jsonb column server-side,
+    other keys of the stored document stay untouched.
+    """
+
+    template = '(%(expressions)s::jsonb)'
+    arg_joiner = ' || '
+
+    def __init__(self, field: str, patch: dict):
+        super().__init__(F(field), Value(json.dumps(patch)), output_field=JSONField())
+
+
+def patch_json(obj, field: str, patch: dict, *conditions, **values) -> int:
+    """
+    Atomically changes only the keys of patch in JSON field of the obj row (plus plain values if any).
+    Optional Q conditions make it a compare-and-set: nothing is written if the row does not match them.
+    Returns the number of rows updated, the field of obj is updated in memory on success.
+    """
+    updated = type(obj).objects.filter(*conditions, pk=obj.pk).update(**{field: JSONBPatch(field, patch)}, **values)
+    if updated:
+        getattr(obj, field).update(patch)
+    return updated
+
+
+class StateWriteBuffer:
+    """
+    Write-behind buffer for state of stated models.
+    Channel updates are written as jsonb patches touching only the changed keys of state.
+    State updates of the same object within the window are merged in memory
+    and flushed with one bulk_update per model. Urgent updates (state automation depends on)
+    are written right away together with anything pending for the object.
+    Zero window disables buffering, every update is written immediately.
+    """
+
+    FIELDS = ('state', 'updated_at')
+
+    def __init__(self, window=0.0):
+        self.window = window
+        self.pending = {}
+        self.updates = 0
+        self.writes = 0
+        self.skipped = 0
+        self._lock = Lock()
+        self._flusher = None
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    @staticmethod
+    def _key(obj):
+        return obj._meta.label_lower, obj.pk
+
+    def is_pending(self, obj):
+        return self._key(obj) in self.pending
+
+    def skip(self):
+        """Counts the update dropped because it would not change anything."""
+        with self._lock:
+            self.skipped += 1
+
+    def add(self, obj, patch=None, urgent=False):
+        """
+        Registers state update of obj. patch is a dict of changed channels,
+        None means the whole state has been replaced.
+        """
+        key = self._key(obj)
+        with self._lock:
+            self.updates += 1
+            _, pending_patch = self.pending.pop(key, (obj, {}))
+            if pending_patch is None or patch is None:
+                patch = None
+            else:
+                patch = {**pending_patch, **patch}
+            if self.enabled and not urgent:
+                self.pending[key] = (obj, patch)
+                if not self._flusher:
+                    self._flusher = Thread(target=self._flush_loop, name='state-writer', daemon=True)
+                    self._flusher.start()
+                return
+            self.writes += 1
+        state = JSONBPatch('state', patch) if patch is not None else dict(obj.state)
+        type(obj).objects.filter(pk=obj.pk).update(state=state, updated_at=timezone.now())
+
+    def _flush_loop(self):
+        while 1:
+            sleep(self.window)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        now = timezone.now()
+        by_model = {}
+        for obj, patch in pending.values():
+            # write a snapshot, the object itself is still being updated by ingest
+            stub = copy(obj)
+            stub.state = JSONBPatch('state', patch) if patch is not None else dict(obj.state)
+            stub.updated_at = now
+            by_model.setdefault(type(obj), []).append(stub)
+        for model, objs in by_model.items():
+            try:
+                model.objects.bulk_update(objs, self.FIELDS)
+            except Exception as e:
+                log(f'Unable to write state of {len(objs)} {model.__name__} objects: {e}', log_type='error')
+        with self._lock:
+            self.writes += len(by_model)
+        log('Flushed state of %s objects', len(pending), log_type='debug')
+
+    def stats(self):
+        return {
+            'window': self.window,
+            'pending': len(self.pending),
+            'updates': self.updates,
+            'writes': self.writes,
+            'skipped': self.skipped
+        }
+
+
+state_writer = StateWriteBuffer(window=config.get('coalescing', {}).get('window', 0))
+atexit.register(state_writer.flush)
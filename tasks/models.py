@@ -55,7 +55,6 @@ class Task(BaseModel):
 
     def do(self):
         log(f'Running the {self}')
-        for action in self.actions.all():
-            action.do()
+        self.actions.model.do_many(self.actions.all())
         self.done = True
         self.save()